@@ -0,0 +1,37 @@
+"""
+Microbenchmark of cache_result hits against functools.lru_cache.
+
+Usage:
+    python benchmarks/bench_cache_result.py
+"""
+import functools
+import sys
+import timeit
+
+from enhancement.cache_result import cache_result
+
+def _function(x, y=0):
+    return x + y
+
+CALLS = {
+    'positional': 'f(1, 2)',
+    'default': 'f(1)',
+    'keyword': 'f(1, y=2)',
+}
+
+def main(number=1_000_000):
+    cached = {
+        'cache_result': cache_result(_function),
+        'lru_cache': functools.lru_cache(maxsize=None)(_function),
+    }
+    print('{:<12}{:>16}{:>16}'.format('call', *cached))
+    for name, call in CALLS.items():
+        row = []
+        for f in cached.values():
+            timer = timeit.Timer(call, globals={'f': f})
+            row.append(min(timer.repeat(repeat=5, number=number)) / number * 1e9)
+        print('{:<12}{:>13.0f} ns{:>13.0f} ns'.format(name, *row))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Benchmarks of the graph engine.
+
+Each scenario builds its graph, times an operation repeated until it has run for at least --min-time seconds, then
+rebuilds the graph under tracemalloc to measure the bytes allocated per vertex.
+
+Usage:
+    python benchmarks/bench_graph.py --output before.json
+    python benchmarks/bench_graph.py --output after.json --compare before.json --tolerance 0.2
+
+With --compare, the ns/op of every scenario is compared to the previous results and the script exits with status 1 if
+any scenario got slower than the tolerance allows.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from importlib import metadata
+
+from enhancement.graph import DiddleScope, GraphObject, SetScope, Vertex, _graph
+
+class Link(GraphObject):
+    def __init__(self, previous=None):
+        super(Link, self).__init__()
+        self.previous = previous
+
+    @Vertex
+    def value(self):
+        return 0 if self.previous is None else self.previous.value() + 1
+
+class Source(GraphObject):
+    @Vertex
+    def value(self):
+        return 1
+
+class Leaf(GraphObject):
+    def __init__(self, source):
+        super(Leaf, self).__init__()
+        self.source = source
+
+    @Vertex
+    def value(self):
+        return self.source.value() * 2
+
+class Sum(GraphObject):
+    def __init__(self, sources):
+        super(Sum, self).__init__()
+        self.sources = sources
+
+    @Vertex
+    def value(self):
+        return sum(source.value() for source in self.sources)
+
+class Node(GraphObject):
+    def __init__(self, left=None, right=None):
+        super(Node, self).__init__()
+        self.left = left
+        self.right = right
+
+    @Vertex
+    def value(self):
+        if self.left is None:
+            return 1
+        return self.left.value() + self.right.value()
+
+def _reset():
+    """Drop the payloads of the previous scenario so that every scenario starts from an empty root state"""
+    _graph.active_state.clear()
+    _graph._edges_changed()
+    gc.collect()
+
+def chain(size):
+    links = [Link()]
+    for _ in range(size - 1):
+        links.append(Link(links[-1]))
+    head, tail = links[0], links[-1]
+    tail.value()
+    values = iter(range(1, sys.maxsize))
+
+    def op():
+        _graph.set_value(head.value, next(values))
+        tail.value()
+    return op, size
+
+def fan_out(size):
+    source = Source()
+    leaves = [Leaf(source) for _ in range(size)]
+    for leaf in leaves:
+        leaf.value()
+    values = iter(range(2, sys.maxsize))
+
+    def op():
+        _graph.set_value(source.value, next(values))
+        for leaf in leaves:
+            leaf.value()
+    return op, size + 1
+
+def fan_in(size):
+    sources = [Source() for _ in range(size)]
+    total = Sum(sources)
+    total.value()
+    values = iter(range(2, sys.maxsize))
+
+    def op():
+        _graph.set_value(sources[0].value, next(values))
+        total.value()
+    return op, size + 1
+
+def diamonds(size):
+    # A lattice of size layers, each node of a layer depending on two neighbours of the previous one
+    width = 8
+    layer = [Node() for _ in range(width)]
+    top = layer[0]
+    for _ in range(size - 1):
+        layer = [Node(layer[i], layer[(i + 1) % width]) for i in range(width)]
+    bottom = layer[0]
+    bottom.value()
+    values = iter(range(2, sys.maxsize))
+
+    def op():
+        _graph.set_value(top.value, next(values))
+        bottom.value()
+    return op, size * width
+
+def set_value_storm(size):
+    links = [Link()]
+    for _ in range(size - 1):
+        links.append(Link(links[-1]))
+    head = links[0]
+    links[-1].value()
+    values = iter(range(1, sys.maxsize))
+
+    def op():
+        _graph.set_value(head.value, next(values))
+    return op, size
+
+def nested_diddle_scopes(size):
+    links = [Link()]
+    for _ in range(size - 1):
+        links.append(Link(links[-1]))
+    head, tail = links[0], links[-1]
+    tail.value()
+    depth = 4
+
+    def op():
+        scopes = []
+        for level in range(depth):
+            scope = DiddleScope()
+            scope.__enter__()
+            _graph.set_diddle(head.value, level)
+            scopes.append(scope)
+        tail.value()
+        for scope in reversed(scopes):
+            scope.__exit__(None, None, None)
+    return op, size
+
+def set_scope_overrides(size):
+    sources = [Source() for _ in range(size)]
+    total = Sum(sources)
+    total.value()
+    overrides = {source.value: 3 for source in sources}
+
+    def op():
+        with SetScope(overrides):
+            total.value()
+    return op, size + 1
+
+def construction(size):
+    # The objects of the last batch stay alive until the next one, so that they are counted by _bytes_per_vertex
+    built = []
+
+    def op():
+        built[:] = [Link() for _ in range(size)]
+    return op, size
+
+SCENARIOS = {
+    'chain': (chain, 200),
+    'fan_out': (fan_out, 1000),
+    'fan_in': (fan_in, 1000),
+    'diamonds': (diamonds, 50),
+    'set_value_storm': (set_value_storm, 1000),
+    'nested_diddle_scopes': (nested_diddle_scopes, 200),
+    'set_scope_overrides': (set_scope_overrides, 1000),
+    'construction': (construction, 1000),
+}
+
+def _time(op, min_time):
+    """Return the best ns/op over batches of operations, after a warm up run"""
+    op()
+    best = None
+    count, deadline = 1, time.perf_counter() + min_time
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            op()
+        batch = time.perf_counter_ns() - start
+        best = batch / count if best is None else min(best, batch / count)
+        if time.perf_counter() >= deadline:
+            return best
+        if batch < 10_000_000:
+            count *= 2
+
+def _bytes_per_vertex(build, size):
+    _reset()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        op, vertices = build(size)
+        op()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return allocated / vertices
+
+def run(names, min_time):
+    results = {}
+    for name in names:
+        build, size = SCENARIOS[name]
+        _reset()
+        op, vertices = build(size)
+        results[name] = {
+            'size': size,
+            'vertices': vertices,
+            'ns_per_op': _time(op, min_time),
+            'bytes_per_vertex': _bytes_per_vertex(build, size),
+        }
+        _reset()
+    return results
+
+def compare(results, previous, tolerance):
+    """Print the ratio of each ns/op to the previous results and return the names of the scenarios that regressed"""
+    regressed = []
+    for name, result in results.items():
+        before = previous.get(name)
+        if before is None:
+            continue
+        ratio = result['ns_per_op'] / before['ns_per_op']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('{:<24}{:>14.0f}{:>14.0f}{:>9.2f}x{}'.format(name, before['ns_per_op'], result['ns_per_op'], ratio, flag))
+    return regressed
+
+def _version():
+    try:
+        return metadata.version('enhancement')
+    except metadata.PackageNotFoundError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the graph engine')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run among {}, all by default'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds to spend timing each scenario')
+    parser.add_argument('--output', help='path of the JSON file to write the results to')
+    parser.add_argument('--compare', help='path of a previous JSON results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown ratio above which --compare fails')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    results = run(args.scenarios or list(SCENARIOS), args.min_time)
+    for name, result in results.items():
+        print('{:<24}{:>14.0f} ns/op{:>12.0f} bytes/vertex'.format(name, result['ns_per_op'], result['bytes_per_vertex']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'version': _version(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'timestamp': time.time(),
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        print()
+        print('{:<24}{:>14}{:>14}{:>10}'.format('scenario', 'before ns/op', 'after ns/op', 'ratio'))
+        if compare(results, previous, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
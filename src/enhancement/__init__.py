@@ -1,6 +1,7 @@
 from .cache_result import *
 from .iterable import *
 from .ndict import *
+from .result_store import *
 from .safe_get import *
 from .singleton import *
 from .timeit import *
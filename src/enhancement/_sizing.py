@@ -0,0 +1,32 @@
+import sys
+from typing import Any
+
+def _estimate_size(value: Any) -> int:
+    """
+    Estimates the bytes held by a value, following the items of built-in containers and using nbytes for arrays.
+
+    Args:
+        value: The value to measure.
+
+    Returns:
+        The estimated size in bytes.
+    """
+    size = 0
+    seen = set()
+    to_visit = [value]
+    while to_visit:
+        value = to_visit.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        nbytes = getattr(value, 'nbytes', None)
+        if isinstance(nbytes, int):
+            size += nbytes
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            to_visit.extend(value.keys())
+            to_visit.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            to_visit.extend(value)
+    return size
@@ -1,47 +1,1262 @@
+import asyncio
+import bisect
+import contextlib
 import functools
 import inspect
-from typing import Any, Callable, TypeVar
+import hashlib
+import os
+import pickle
+import threading
+import time
+import types
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar, Union
+from ._sizing import _estimate_size
+from .result_store import ResultStore, stable_hash
 
 T = TypeVar('T')
 
-def cache_result(wrapped_func: Callable[..., T]) -> Callable[..., T]:
+_MISSING = object()
+
+class _Fingerprint(object):
+    """Tags the fingerprint of an unhashable argument, so it never equals a hashable argument."""
+
+    def __repr__(self) -> str:
+        return '<fingerprint>'
+
+    def __reduce__(self) -> str:
+        # Unpickles to the module's instance, so fingerprints keep their stable hash
+        return '_FINGERPRINT'
+
+_FINGERPRINT = _Fingerprint()
+
+# The number of locks the in-flight calls of a thread-safe cache are spread over
+_STRIPES = 64
+
+class _Source(object):
+    """A default value standing for the name it is bound to in the namespace of a generated key builder."""
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __repr__(self) -> str:
+        return self._name
+
+def _key_builder(signature: inspect.Signature) -> Tuple[Callable[..., tuple], int]:
+    """
+    Generates a function with the given signature that returns its arguments as a tuple in parameter order, so that
+    the interpreter binds them and applies the defaults instead of inspect doing it on every call.
+
+    Args:
+        signature: The signature of the function whose calls are to be turned into cache keys.
+
+    Returns:
+        The key builder, and the number of positional parameters when the signature only has positional parameters
+        (a call passing exactly that many positional arguments can use them as its key), otherwise -1.
+    """
+    namespace: Dict[str, Any] = {'_cache_result_tuple': tuple, '_cache_result_sorted': sorted}
+    parameters, items = [], []
+    all_positional = True
+    for index, parameter in enumerate(signature.parameters.values()):
+        default = parameter.default
+        if default is not parameter.empty:
+            name = '_default{}'.format(index)
+            namespace[name] = default
+            default = _Source(name)
+        parameters.append(parameter.replace(annotation=parameter.empty, default=default))
+        if parameter.kind is parameter.VAR_KEYWORD:
+            items.append('_cache_result_tuple(_cache_result_sorted({}.items()))'.format(parameter.name))
+        else:
+            items.append(parameter.name)
+        if parameter.kind not in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+            all_positional = False
+    signature = signature.replace(parameters=parameters, return_annotation=signature.empty)
+    source = 'def key{}:\n    return ({})\n'.format(signature, ''.join(item + ', ' for item in items))
+    exec(source, namespace)
+    return namespace['key'], len(parameters) if all_positional else -1
+
+# The hashers of unhashable argument types, set through register_hasher
+_HASHERS: Dict[type, Callable[[Any], Any]] = {}
+# The hasher of each type met so far, found along its MRO, or None
+_TYPE_HASHERS: Dict[type, Optional[Callable[[Any], Any]]] = {}
+
+def register_hasher(cls: type, hasher: Callable[[Any], Any]) -> None:
+    """
+    Registers how to fingerprint the unhashable arguments of type cls, or of its subclasses, so that calls taking them
+    can be cached. Two arguments with equal fingerprints are considered equal.
+
+    Args:
+        cls: The type of argument.
+        hasher: A function returning the fingerprint of an argument, which may itself contain unhashable values.
+
+    Example:
+    >>> register_hasher(pd.DataFrame, lambda df: (tuple(df.columns), df.to_numpy()))
+    """
+    _HASHERS[cls] = hasher
+    _TYPE_HASHERS.clear()
+
+def _hasher_of(cls: type) -> Optional[Callable[[Any], Any]]:
+    try:
+        return _TYPE_HASHERS[cls]
+    except KeyError:
+        hasher = next((_HASHERS[base] for base in cls.__mro__ if base in _HASHERS), None)
+        _TYPE_HASHERS[cls] = hasher
+        return hasher
+
+def _hash_buffer(value: Any) -> Optional[tuple]:
+    """Hashes the content of an object exposing a buffer, like an array, or returns None if it does not expose one."""
+    try:
+        view = memoryview(value)
+    except (TypeError, ValueError, BufferError):
+        # Not a buffer, or one whose format memoryview does not support, such as a datetime64 array
+        return None
+    if 'O' in view.format:
+        # A buffer of object pointers says nothing about the objects' values
+        return None
+    digest = hashlib.blake2b(view if view.c_contiguous else view.tobytes(), digest_size=16).digest()
+    return (view.format, view.shape, digest)
+
+def _fingerprint(value: Any, _active: Optional[set] = None) -> Hashable:
+    """
+    Returns value itself if it is hashable, otherwise a hashable fingerprint of its content and type: containers are
+    fingerprinted item by item, arrays and other buffers over their bytes, and other types through register_hasher.
+
+    Args:
+        value: The value to fingerprint.
+
+    Returns:
+        The fingerprint.
+
+    Raises:
+        TypeError: If the value, or one of its items, is unhashable and cannot be fingerprinted.
+    """
+    cls = type(value)
+    hasher = _hasher_of(cls)
+    if hasher is None:
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            pass
+    active = set() if _active is None else _active
+    if id(value) in active:
+        raise TypeError('Cannot fingerprint a self-referencing {}'.format(cls.__name__))
+    active.add(id(value))
+    try:
+        if hasher is not None:
+            content = _fingerprint(hasher(value), active)
+        elif isinstance(value, (list, tuple)):
+            content = tuple(_fingerprint(item, active) for item in value)
+        elif isinstance(value, dict):
+            content = frozenset((_fingerprint(k, active), _fingerprint(v, active)) for k, v in value.items())
+        elif isinstance(value, (set, frozenset)):
+            content = frozenset(value)
+        else:
+            content = _hash_buffer(value)
+            if content is None:
+                tolist = getattr(value, 'tolist', None)
+                if tolist is None:
+                    raise TypeError('Cannot fingerprint unhashable type {}'.format(cls.__name__))
+                content = (getattr(value, 'shape', None), _fingerprint(tolist(), active))
+    finally:
+        active.discard(id(value))
+    return (_FINGERPRINT, cls, content)
+
+class _SessionBoundaries(object):
+    """
+    The open or close times of the sessions of an exchange, as sorted epoch seconds, so that the next one after a given
+    time is found by bisection instead of querying the calendar.
+    """
+
+    def __init__(self, exchange: str, event: str) -> None:
+        self._exchange = exchange
+        self._event = event
+        self._times: List[float] = []
+        self._load(time.time())
+
+    def _load(self, now: float) -> None:
+        # Imported here so that exchange_calendars is only loaded by caches expiring on sessions
+        import exchange_calendars as xcals
+        import pandas as pd
+
+        start = pd.Timestamp(now, unit='s').normalize() - pd.Timedelta(days=7)
+        calendar = xcals.get_calendar(self._exchange, start=start, end=start + pd.Timedelta(days=366))
+        times = calendar.opens if self._event == 'open' else calendar.closes
+        self._times = (times.values.astype('int64') / 1e9).tolist()
+
+    def next_after(self, now: float) -> float:
+        index = bisect.bisect_right(self._times, now)
+        if index == len(self._times):
+            # Past the table, as in a process running for over a year
+            self._load(now)
+            index = bisect.bisect_right(self._times, now)
+        return self._times[index]
+
+# The session boundaries of each expire_on spec, loaded once per process
+_SESSION_BOUNDARIES: Dict[str, _SessionBoundaries] = {}
+_SESSION_EVENTS = ('open', 'close')
+
+def _parse_expire_on(expire_on: str) -> Tuple[str, str]:
+    exchange, _, event = expire_on.partition(':')
+    if not exchange or event not in _SESSION_EVENTS:
+        raise ValueError("Invalid expire_on {!r}, expected an exchange and an event such as 'XNYS:close'".format(expire_on))
+    return exchange, event
+
+def _session_boundaries(expire_on: str) -> _SessionBoundaries:
+    boundaries = _SESSION_BOUNDARIES.get(expire_on)
+    if boundaries is None:
+        boundaries = _SESSION_BOUNDARIES[expire_on] = _SessionBoundaries(*_parse_expire_on(expire_on))
+    return boundaries
+
+class _BoundedCache(ABC):
+    """
+    A dict-like cache holding at most maxsize entries and max_bytes estimated bytes, whose entries expire ttl seconds
+    after being stored or at the next session boundary of expire_on. Subclasses order the entries to pick which one to
+    evict, in constant time. Every access takes a short lock of the cache, as even a hit reorders the entries, so that
+    a bounded cache can be called from several threads whether or not the cached function is thread-safe.
+    """
+
+    def __init__(
+        self,
+        maxsize: Optional[int] = None,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        expire_on: Optional[str] = None,
+    ) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._sessions = _session_boundaries(expire_on) if expire_on is not None else None
+        self._values: Dict[Hashable, Any] = self._new_values()
+        # The deadline of an entry only grows with the time it was stored at, so the insertion order of the deadlines
+        # is also their expiry order
+        expires = ttl is not None or expire_on is not None
+        self._deadlines: Optional[Dict[Hashable, float]] = OrderedDict() if expires else None
+        self._sizes: Optional[Dict[Hashable, int]] = {} if max_bytes is not None else None
+        self._bytes = 0
+        self.evictions = 0
+        # Called with the key of every entry leaving the cache
+        self.on_remove: Optional[Callable[[Hashable], None]] = None
+        self._lock = threading.Lock()
+
+    def _new_values(self) -> Dict[Hashable, Any]:
+        return {}
+
+    @property
+    def bytes(self) -> int:
+        """Returns the estimated size of the values held, when max_bytes is set."""
+        return self._bytes
+
+    def _now(self) -> float:
+        # Session boundaries are points in time, while a ttl is better measured on the monotonic clock
+        return time.time() if self._sessions is not None else time.monotonic()
+
+    def _deadline(self, now: float) -> float:
+        deadline = now + self._ttl if self._ttl is not None else float('inf')
+        if self._sessions is not None:
+            deadline = min(deadline, self._sessions.next_after(now))
+        return deadline
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._values.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            if self._deadlines is not None and self._deadlines[key] <= self._now():
+                self._remove(key)
+                return default
+            self._touch(key)
+            return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.set(key, value)
+
+    def set(self, key: Hashable, value: Any, lifetime: Optional[float] = None) -> None:
+        """Stores value under key, expiring it after lifetime seconds at the latest, as for a result read from a store."""
+        if self._maxsize is not None and self._maxsize <= 0:
+            return
+        size = 0
+        if self._sizes is not None:
+            # Measured before locking, as it walks the whole value
+            size = _estimate_size(value)
+            if size > self._max_bytes:
+                # Storing it would evict everything else
+                return
+        with self._lock:
+            if key in self._values:
+                self._remove(key)
+            if self._deadlines is not None:
+                now = self._now()
+                self._expire(now)
+            if self._maxsize is not None:
+                while len(self._values) >= self._maxsize:
+                    self._evict()
+            if self._sizes is not None:
+                while self._values and self._bytes + size > self._max_bytes:
+                    self._evict()
+                self._sizes[key] = size
+                self._bytes += size
+            self._values[key] = value
+            self._insert(key)
+            if self._deadlines is not None:
+                deadline = self._deadline(now)
+                if lifetime is not None:
+                    # A shortened deadline breaks the expiry order, the entry is then only purged when read or evicted
+                    deadline = min(deadline, now + lifetime)
+                self._deadlines[key] = deadline
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def holds(self, key: Hashable) -> bool:
+        """Returns whether an entry is stored under key, without touching or expiring it."""
+        return key in self._values
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._values.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._remove(key)
+            return value
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            if self._deadlines is not None:
+                self._deadlines.clear()
+            if self._sizes is not None:
+                self._sizes.clear()
+            self._bytes = 0
+            self._clear_order()
+
+    def _expire(self, now: float) -> None:
+        deadlines = self._deadlines
+        while deadlines:
+            key, deadline = next(iter(deadlines.items()))
+            if deadline > now:
+                break
+            self._remove(key)
+
+    def _evict(self) -> None:
+        self._remove(self._victim())
+        self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        del self._values[key]
+        self._discard(key)
+        if self._deadlines is not None:
+            self._deadlines.pop(key, None)
+        if self._sizes is not None:
+            self._bytes -= self._sizes.pop(key)
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    # Subclasses keeping their own order besides the values override these hooks
+    def _insert(self, key: Hashable) -> None:
+        pass
+
+    def _discard(self, key: Hashable) -> None:
+        pass
+
+    def _clear_order(self) -> None:
+        pass
+
+    @abstractmethod
+    def _touch(self, key: Hashable) -> None:
+        """Records a use of the entry stored under key."""
+
+    @abstractmethod
+    def _victim(self) -> Hashable:
+        """Returns the key of the entry to evict."""
+
+class _LRUCache(_BoundedCache):
+    """Evicts the least recently used entry, the values are kept in recency order."""
+
+    def _new_values(self) -> Dict[Hashable, Any]:
+        return OrderedDict()
+
+    def _touch(self, key: Hashable) -> None:
+        self._values.move_to_end(key)
+
+    def _victim(self) -> Hashable:
+        return next(iter(self._values))
+
+class _LFUCache(_BoundedCache):
+    """Evicts the least frequently used entry, the oldest first among equally used ones."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._counts: Dict[Hashable, int] = {}
+        # The keys used count times, in the order they reached that count
+        self._buckets: Dict[int, Dict[Hashable, None]] = {}
+        self._min_count = 0
+
+    def _insert(self, key: Hashable) -> None:
+        self._counts[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_count = 1
+
+    def _touch(self, key: Hashable) -> None:
+        count = self._counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = count + 1
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def _discard(self, key: Hashable) -> None:
+        count = self._counts.pop(key)
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+    def _victim(self) -> Hashable:
+        if self._min_count not in self._buckets:
+            # Only expired or replaced entries can empty the least used bucket outside of _touch
+            self._min_count = min(self._buckets)
+        return next(iter(self._buckets[self._min_count]))
+
+    def _clear_order(self) -> None:
+        self._counts.clear()
+        self._buckets.clear()
+        self._min_count = 0
+
+class Tagged(object):
+    """
+    A result returned along with the tags of its cache entry, which the cached function unwraps.
+
+    Example:
+    >>> @cache_result
+    ... def load_curve(currency):
+    ...     return Tagged(build_curve(currency), ['curves', currency])
+    >>> load_curve.invalidate(tag='usd')
+    """
+    __slots__ = ('value', 'tags')
+
+    def __init__(self, value: Any, tags: Iterable[Hashable]) -> None:
+        self.value = value
+        self.tags = tuple(tags)
+
+def _untag(res: Any) -> Tuple[Any, Tuple[Hashable, ...]]:
+    if isinstance(res, Tagged):
+        return res.value, res.tags
+    return res, ()
+
+def _untagged(wrapped_func: Callable[..., Any]) -> Callable[..., Any]:
+    """Returns wrapped_func calling through which unwraps Tagged results, for the calls that bypass the cache."""
+    if inspect.iscoroutinefunction(wrapped_func):
+        async def untagged(*args: Any, **kwargs: Any) -> Any:
+            return _untag(await wrapped_func(*args, **kwargs))[0]
+    else:
+        def untagged(*args: Any, **kwargs: Any) -> Any:
+            return _untag(wrapped_func(*args, **kwargs))[0]
+    return untagged
+
+class _TagIndex(object):
+    """
+    The inverted index of the tags of a cache's entries, along with the tags of each key so that the index can be cleaned
+    up in proportion to the tags of an entry when it is evicted, expires or is invalidated.
+    """
+
+    def __init__(self, tag_func: Optional[Callable[..., Iterable[Hashable]]]) -> None:
+        self._tag_func = tag_func
+        # The keys of each tag, in a dict used as an ordered set
+        self._keys: Dict[Hashable, Dict[Hashable, None]] = {}
+        self._tags: Dict[Hashable, Tuple[Hashable, ...]] = {}
+        self._lock = threading.Lock()
+
+    def tags(self, tags: Tuple[Hashable, ...], args: tuple, kwargs: Dict[str, Any]) -> Tuple[Hashable, ...]:
+        """Returns the tags returned with a result along with those derived from the arguments of its call."""
+        if self._tag_func is not None:
+            tags += tuple(self._tag_func(*args, **kwargs))
+        return tags
+
+    def add(self, cache: Any, key: Hashable, tags: Tuple[Hashable, ...]) -> None:
+        """Indexes the tags of the result stored under key, as returned by tags()."""
+        if not tags or (not isinstance(cache, dict) and not cache.holds(key)):
+            return
+        with self._lock:
+            self._discard(key)
+            self._tags[key] = tags
+            for tag in tags:
+                self._keys.setdefault(tag, {})[key] = None
+
+    def keys(self, tag: Hashable) -> List[Hashable]:
+        with self._lock:
+            return list(self._keys.get(tag, ()))
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: Hashable) -> None:
+        for tag in self._tags.pop(key, ()):
+            keys = self._keys[tag]
+            del keys[key]
+            if not keys:
+                del self._keys[tag]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+            self._tags.clear()
+
+def _attach(
+    wrapper_func: Callable[..., Any],
+    cache: Any,
+    index: _TagIndex,
+    build_key: Callable[..., tuple],
+    lock: Optional[threading.Lock] = None,
+    tier: Optional['_PersistentTier'] = None,
+) -> Callable[..., Any]:
+    """
+    Attaches the cache and its management functions to a wrapped function.
+
+    Args:
+        wrapper_func: The wrapped function.
+        cache: The dict or bounded cache holding the results.
+        index: The index of the tags of the cached results.
+        build_key: The key builder of the function.
+        lock: The lock under which results are stored and indexed, if any.
+        tier: The persistent tier behind the cache, if any, which invalidate removes results from as well.
+
+    Returns:
+        The wrapped function.
+    """
+    guard = lock if lock is not None else contextlib.nullcontext()
+
+    def reset_cache() -> None:
+        """Clears the cache of stored results."""
+        with guard:
+            cache.clear()
+            index.clear()
+
+    def cache_key(*args: Any, **kwargs: Any) -> Hashable:
+        """Returns the key of the result of a call with the given arguments."""
+        key = build_key(*args, **kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            key = _fingerprint(key)
+        return key
+
+    def invalidate(tag: Optional[Hashable] = None, key: Optional[Hashable] = None) -> int:
+        """
+        Removes the results tagged with tag and the result stored under key, as returned by cache_key, from the cache
+        and from its store.
+
+        Returns:
+            The number of results removed.
+        """
+        removed = []
+        # Under the same lock as the stores, so a result cannot be stored before its tags are indexed
+        with guard:
+            keys = index.keys(tag) if tag is not None else []
+            if key is not None:
+                keys.append(key)
+            for k in keys:
+                if cache.pop(k, _MISSING) is not _MISSING:
+                    removed.append(k)
+                index.discard(k)
+            if tier is None:
+                return len(removed)
+            stored = tier.invalidate(tag, keys)
+        # Results removed from both the cache and the store count once
+        stored.difference_update(tier.stored_key(k) for k in removed)
+        return len(removed) + len(stored)
+
+    # Type declaration for cache
+    wrapper_func._results_cache = cache
+    wrapper_func._tag_index = index
+    wrapper_func.reset_cache = reset_cache
+    wrapper_func.cache_key = cache_key
+    wrapper_func.invalidate = invalidate
+    return wrapper_func
+
+class _Flight(object):
+    """A call in progress, whose result or error is handed to the callers waiting for the same key."""
+
+    def __init__(self) -> None:
+        self.owner = threading.current_thread()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+    def result(self) -> Any:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def _code_version(wrapped_func: Callable[..., Any]) -> str:
+    """
+    Hashes the bytecode of a function along with the constants and names it uses, recursing into the functions it
+    defines, so that editing the function changes its version while moving it around its file does not.
+
+    Args:
+        wrapped_func: The function to version.
+
+    Returns:
+        The hex digest of its code, or an empty string for callables without Python code.
+    """
+    code = getattr(inspect.unwrap(wrapped_func), '__code__', None)
+    if code is None:
+        return ''
+    digest = hashlib.blake2b(digest_size=16)
+    to_visit = [code]
+    while to_visit:
+        code = to_visit.pop()
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                to_visit.append(const)
+            else:
+                # The repr of a frozenset, as in `x in {'a', 'b'}`, would depend on the process's hash seed
+                digest.update(stable_hash(const).encode())
+    return digest.hexdigest()
+
+# The layout of the records of a persistent tier, part of their keys so that another layout is never misread
+_TIER_FORMAT = 3
+# Marks the hashes of tags apart from those of keys
+_TAG = 'tag'
+
+# What a cache without a persistent tier reads from it
+_NOT_STORED: Tuple[Any, Tuple[Hashable, ...], Optional[float]] = (_MISSING, (), None)
+
+def _store_result(cache: Any, key: Hashable, value: Any, lifetime: Optional[float]) -> None:
+    if lifetime is None or isinstance(cache, dict):
+        cache[key] = value
+    else:
+        cache.set(key, value, lifetime)
+
+class _PersistentTier(object):
+    """
+    The results of a function kept in a ResultStore behind its in-memory cache, under a stable hash of the function's
+    qualified name, its version and the call's key, so that other and later processes can read them.
+    """
+
+    def __init__(
+        self,
+        wrapped_func: Callable[..., Any],
+        store: ResultStore,
+        version: Optional[str],
+        ttl: Optional[float] = None,
+        expire_on: Optional[str] = None,
+    ) -> None:
+        self._store = store
+        self._ttl = ttl
+        self._sessions = _session_boundaries(expire_on) if expire_on is not None else None
+        self._prefix = (
+            _TIER_FORMAT,
+            wrapped_func.__module__,
+            wrapped_func.__qualname__,
+            version if version is not None else _code_version(wrapped_func),
+        )
+
+    def _deadline(self, now: float) -> Optional[float]:
+        # In epoch seconds, as the store is shared with other processes
+        deadline = now + self._ttl if self._ttl is not None else None
+        if self._sessions is not None:
+            boundary = self._sessions.next_after(now)
+            deadline = boundary if deadline is None else min(deadline, boundary)
+        return deadline
+
+    def stored_key(self, key: Hashable) -> Optional[str]:
+        """Returns the key a result is stored under, or None if the key of its call cannot be hashed stably."""
+        try:
+            return stable_hash(self._prefix + (key,))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def _tag(self, tag: Hashable) -> Optional[str]:
+        try:
+            return stable_hash(self._prefix + (_TAG, tag))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def get(self, key: Hashable) -> Tuple[Any, Tuple[Hashable, ...], Optional[float]]:
+        """
+        Returns the stored result, the tags it was returned with and the seconds left before it expires, None if it
+        does not, or _MISSING.
+        """
+        stored_key = self.stored_key(key)
+        if stored_key is None:
+            return _MISSING, (), None
+        record = self._store.get(stored_key, _MISSING)
+        if record is _MISSING:
+            return _MISSING, (), None
+        deadline, res_tags, value = record
+        if deadline is None:
+            return value, res_tags, None
+        lifetime = deadline - time.time()
+        if lifetime <= 0:
+            self._store.delete(stored_key)
+            return _MISSING, (), None
+        return value, res_tags, lifetime
+
+    def put(self, key: Hashable, value: Any, res_tags: Tuple[Hashable, ...], tags: Tuple[Hashable, ...]) -> None:
+        """Stores a result along with the tags it was returned with, indexed under all of its tags."""
+        stored_key = self.stored_key(key)
+        if stored_key is None:
+            return
+        stored_tags = [self._tag(tag) for tag in tags]
+        try:
+            self._store.put(
+                stored_key, (self._deadline(time.time()), res_tags, value), [tag for tag in stored_tags if tag is not None]
+            )
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # Results that cannot be pickled stay in memory only
+            pass
+
+    def invalidate(self, tag: Optional[Hashable], keys: Iterable[Hashable]) -> Set[str]:
+        """Removes the stored results carrying tag and those stored under keys, returning their stored keys."""
+        removed = set()
+        if tag is not None:
+            stored_tag = self._tag(tag)
+            if stored_tag is not None:
+                removed.update(self._store.delete_tagged(stored_tag))
+        for key in keys:
+            stored_key = self.stored_key(key)
+            if stored_key is not None and stored_key not in removed and self._store.delete(stored_key):
+                removed.add(stored_key)
+        return removed
+
+_POLICIES = {
+    'lru': _LRUCache,
+    'lfu': _LFUCache,
+}
+
+def cache_result(
+    wrapped_func: Optional[Callable[..., T]] = None,
+    *,
+    maxsize: Optional[int] = None,
+    policy: str = 'lru',
+    ttl: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    thread_safe: bool = False,
+    store: Optional[Union[str, os.PathLike, ResultStore]] = None,
+    version: Optional[str] = None,
+    per_instance: bool = False,
+    expire_on: Optional[str] = None,
+    tags: Optional[Callable[..., Iterable[Hashable]]] = None,
+) -> Callable[..., T]:
     """
     A decorator that caches the results of a function call.
-    
+
+    Args:
+        wrapped_func: The function to be wrapped with caching functionality.
+        maxsize: The maximum number of results kept, unbounded by default.
+        policy: Which result to evict once a bound is reached, 'lru' for the least recently used or 'lfu' for the
+            least frequently used.
+        ttl: The number of seconds after which a result expires.
+        max_bytes: The maximum estimated size of the results kept, a single larger result is not cached.
+        thread_safe: Whether concurrent callers missing the same key wait for a single call instead of each calling
+            the function. Errors are raised to all of them without being cached. Either way, the cache itself can be
+            called from several threads.
+        store: A ResultStore, or the path of one, keeping the results behind the in-memory cache so that other and
+            later processes read them instead of calling the function. reset_cache() leaves the store untouched.
+            Stored results expire with ttl and expire_on as well.
+        version: The version of the stored results, by default a hash of the function's code so that editing the
+            function stops it from reading the results of its previous code.
+        per_instance: Whether the decorated method caches its results separately for each instance, in a cache that
+            only lives as long as the instance, instead of keying one cache on self and keeping every instance alive.
+            obj.method.reset_cache() then only clears the results of obj.
+        expire_on: An exchange and a session event, such as 'XNYS:close' or 'XLON:open', at the next occurrence of
+            which results expire. The session times are read once from exchange_calendars.
+        tags: A function taking the arguments of a call and returning the tags of its result, which the function can
+            also return along with its result in a Tagged.
+
+    Returns:
+        A wrapped function that implements caching of results, or a decorator when called with options only.
+
+    The wrapped function includes a reset_cache() method to clear the cache, and an invalidate(tag=..., key=...) method
+    to only remove the results carrying a tag, or stored under the key returned by its cache_key(*args, **kwargs) method.
+    invalidate also removes them from the store, where their tags are kept along with them.
+    Coroutine functions cache the awaited result, and concurrent awaiters of the same key share one task.
+    Calls are keyed on their arguments in parameter order with the defaults applied, so f(1), f(1, y=0) and f(x=1)
+    share an entry. Unhashable arguments, such as lists, dicts and arrays, are keyed by a fingerprint of their content,
+    see register_hasher. Calls with arguments that cannot be fingerprinted are not cached.
+
+    Example:
+    >>> @cache_result(maxsize=1024, policy='lfu', ttl=60)
+    ... def fetch_curve(currency):
+    ...     ...
+    """
+    if policy not in _POLICIES:
+        raise ValueError('Unknown cache policy {!r}, expected one of {}'.format(policy, ', '.join(_POLICIES)))
+    if expire_on is not None:
+        _parse_expire_on(expire_on)
+    if per_instance and store is not None:
+        raise ValueError('The results of per-instance caches cannot be stored, as their keys do not identify the instance')
+    if wrapped_func is None:
+        return functools.partial(
+            cache_result, maxsize=maxsize, policy=policy, ttl=ttl, max_bytes=max_bytes, thread_safe=thread_safe,
+            store=store, version=version, per_instance=per_instance, expire_on=expire_on, tags=tags
+        )
+    if per_instance:
+        return _CachedMethod(
+            wrapped_func, maxsize=maxsize, policy=policy, ttl=ttl, max_bytes=max_bytes, thread_safe=thread_safe,
+            expire_on=expire_on, tags=tags
+        )
+
+    # The signature is only analysed once, the key builder binds the arguments of each call
+    build_key, arity = _key_builder(inspect.signature(wrapped_func))
+    tier = None
+    if store is not None:
+        tier = _PersistentTier(
+            wrapped_func, ResultStore(store) if isinstance(store, (str, os.PathLike)) else store, version, ttl, expire_on
+        )
+    return _cached(wrapped_func, build_key, arity, maxsize, policy, ttl, max_bytes, thread_safe, expire_on, tags, tier)
+
+def _cached(
+    wrapped_func: Callable[..., T],
+    build_key: Callable[..., tuple],
+    arity: int,
+    maxsize: Optional[int],
+    policy: str,
+    ttl: Optional[float],
+    max_bytes: Optional[int],
+    thread_safe: bool,
+    expire_on: Optional[str],
+    tags: Optional[Callable[..., Iterable[Hashable]]],
+    tier: Optional[_PersistentTier] = None,
+    stripes: Optional[List[threading.Lock]] = None,
+) -> Callable[..., T]:
+    """
+    Wraps wrapped_func in a new cache, given its key builder, so that the key builder and the stripe locks of
+    single-flight calls can be shared by the caches of several functions with the same signature. The options not
+    listed below are those of cache_result.
+
     Args:
         wrapped_func: The function to be wrapped with caching functionality.
-        
+        build_key: The key builder of wrapped_func.
+        arity: The number of positional parameters whose arguments can be used as a key, or -1.
+        tier: The persistent tier behind the cache, if any.
+        stripes: The stripe locks of single-flight calls, new ones by default.
+
     Returns:
-        A wrapped function that implements caching of results.
-        
-    The wrapped function includes a reset_cache() method to clear the cache.
+        The wrapped function.
     """
-    # Get the parameter names of the wrapped function
-    params = inspect.signature(wrapped_func).parameters
-    
+    if maxsize is None and ttl is None and max_bytes is None and expire_on is None:
+        cache: Any = {}
+    else:
+        cache = _POLICIES[policy](maxsize, ttl, max_bytes, expire_on)
+    index = _TagIndex(tags)
+    if not isinstance(cache, dict):
+        cache.on_remove = index.discard
+    direct = _untagged(wrapped_func)
+    if inspect.iscoroutinefunction(wrapped_func):
+        return _coroutine(wrapped_func, direct, build_key, arity, cache, tier, index)
+    if thread_safe:
+        return _single_flight(wrapped_func, direct, build_key, arity, cache, tier, index, stripes)
+
     @functools.wraps(wrapped_func)
     def wrapper_func(*args: Any, **kwargs: Any) -> T:
+        if kwargs or len(args) != arity:
+            try:
+                key = build_key(*args, **kwargs)
+            except TypeError:
+                # The arguments do not match the signature, let the function raise its own error
+                return direct(*args, **kwargs)
+        else:
+            # Every positional parameter was passed positionally, the arguments already are the key
+            key = args
         try:
-            # Convert positional arguments to keyword arguments
-            bound_args = inspect.signature(wrapped_func).bind(*args, **kwargs)
-            bound_args.apply_defaults()
-            # Create a normalized key from all arguments as kwargs
-            key = tuple(sorted(bound_args.arguments.items()))
-            
-            res = wrapper_func._results_cache.get(key)
-            if res is None:
-                res = wrapper_func._results_cache[key] = wrapped_func(*args, **kwargs)
+            res = cache.get(key, _MISSING)
+        except TypeError:
+            # Unhashable arguments are looked up by their fingerprint
+            try:
+                key = _fingerprint(key)
+            except TypeError:
+                # Fall back to calling the function directly if arguments cannot be fingerprinted
+                return direct(*args, **kwargs)
+            res = cache.get(key, _MISSING)
+        if res is _MISSING:
+            res, res_tags, lifetime = tier.get(key) if tier is not None else _NOT_STORED
+            computed = res is _MISSING
+            if computed:
+                res, res_tags = _untag(wrapped_func(*args, **kwargs))
+            tags = index.tags(res_tags, args, kwargs)
+            if computed and tier is not None:
+                tier.put(key, res, res_tags, tags)
+            _store_result(cache, key, res, lifetime)
+            index.add(cache, key, tags)
+        return res
+
+    return _attach(wrapper_func, cache, index, build_key, tier=tier)
+
+
+def _single_flight(
+    wrapped_func: Callable[..., T],
+    direct: Callable[..., T],
+    build_key: Callable[..., tuple],
+    arity: int,
+    cache: Any,
+    tier: Optional[_PersistentTier],
+    index: _TagIndex,
+    stripes: Optional[List[threading.Lock]] = None,
+) -> Callable[..., T]:
+    """
+    Wraps wrapped_func so that concurrent calls missing the same key wait for the first one. The in-flight calls are
+    registered under one of _STRIPES locks chosen by key, so callers of different keys rarely share a lock, and no lock
+    is held while wrapped_func runs. A bounded cache, whose hits reorder its entries, is also guarded by its own lock.
+
+    Args:
+        wrapped_func: The function to be wrapped with caching functionality.
+        direct: The function to call when a call bypasses the cache.
+        build_key: The key builder of wrapped_func.
+        arity: The number of positional parameters whose arguments can be used as a key, or -1.
+        cache: The dict or bounded cache holding the results.
+        tier: The persistent tier behind the cache, if any.
+        index: The index of the tags of the cached results.
+        stripes: The _STRIPES locks to register the in-flight calls under, new ones by default.
+
+    Returns:
+        The wrapped function.
+    """
+    if stripes is None:
+        stripes = [threading.Lock() for _ in range(_STRIPES)]
+    flights: Dict[Hashable, _Flight] = {}
+    # Results are stored and their tags indexed under one lock, which invalidate takes as well
+    store_lock = threading.Lock()
+
+    def lookup(key: Hashable) -> Any:
+        return cache.get(key, _MISSING)
+
+    def store(key: Hashable, value: Any, tags: Tuple[Hashable, ...], lifetime: Optional[float]) -> None:
+        with store_lock:
+            _store_result(cache, key, value, lifetime)
+            index.add(cache, key, tags)
+
+    @functools.wraps(wrapped_func)
+    def wrapper_func(*args: Any, **kwargs: Any) -> T:
+        if kwargs or len(args) != arity:
+            try:
+                key = build_key(*args, **kwargs)
+            except TypeError:
+                # The arguments do not match the signature, let the function raise its own error
+                return direct(*args, **kwargs)
+        else:
+            key = args
+        try:
+            res = lookup(key)
+        except TypeError:
+            # Unhashable arguments are looked up by their fingerprint
+            try:
+                key = _fingerprint(key)
+            except TypeError:
+                # Fall back to calling the function directly if arguments cannot be fingerprinted
+                return direct(*args, **kwargs)
+            res = lookup(key)
+        if res is not _MISSING:
+            return res
+
+        stripe = stripes[hash(key) % _STRIPES]
+        with stripe:
+            res = lookup(key)
+            if res is not _MISSING:
+                return res
+            flight = flights.get(key)
+            if flight is None:
+                flight = flights[key] = _Flight()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            if flight.owner is threading.current_thread():
+                raise RuntimeError('{} called itself with the same arguments'.format(wrapped_func.__qualname__))
+            return flight.result()
+
+        try:
+            res, res_tags, lifetime = tier.get(key) if tier is not None else _NOT_STORED
+            computed = res is _MISSING
+            if computed:
+                res, res_tags = _untag(wrapped_func(*args, **kwargs))
+            tags = index.tags(res_tags, args, kwargs)
+            if computed and tier is not None:
+                tier.put(key, res, res_tags, tags)
+        except BaseException as error:
+            with stripe:
+                del flights[key]
+            flight.error = error
+            flight.done.set()
+            raise
+        # Storing and landing together, a later caller either finds the flight or the stored result
+        with stripe:
+            store(key, res, tags, lifetime)
+            del flights[key]
+        flight.value = res
+        flight.done.set()
+        return res
+
+    return _attach(wrapper_func, cache, index, build_key, store_lock, tier)
+
+def _coroutine(
+    wrapped_func: Callable[..., Any],
+    direct: Callable[..., Any],
+    build_key: Callable[..., tuple],
+    arity: int,
+    cache: Any,
+    tier: Optional[_PersistentTier],
+    index: _TagIndex,
+) -> Callable[..., Any]:
+    """
+    Wraps the coroutine function wrapped_func so that the awaited result is cached rather than the coroutine. A miss
+    starts a task, which the other awaiters of the same key on the same event loop await as well, each through a shield
+    so that cancelling one awaiter does not cancel the call for the others.
+
+    Args:
+        wrapped_func: The coroutine function to be wrapped with caching functionality.
+        direct: The coroutine function to call when a call bypasses the cache.
+        build_key: The key builder of wrapped_func.
+        arity: The number of positional parameters whose arguments can be used as a key, or -1.
+        cache: The dict or bounded cache holding the results.
+        tier: The persistent tier behind the cache, if any.
+        index: The index of the tags of the cached results.
+
+    Returns:
+        The wrapped coroutine function.
+    """
+    # Keyed by event loop as well, since a task can only be awaited from its own loop
+    tasks: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+
+    async def call(task_key: Tuple[asyncio.AbstractEventLoop, Hashable], args: tuple, kwargs: Dict[str, Any]) -> Any:
+        key = task_key[1]
+        try:
+            res, res_tags, lifetime = tier.get(key) if tier is not None else _NOT_STORED
+            computed = res is _MISSING
+            if computed:
+                res, res_tags = _untag(await wrapped_func(*args, **kwargs))
+            tags = index.tags(res_tags, args, kwargs)
+            if computed and tier is not None:
+                tier.put(key, res, res_tags, tags)
+            _store_result(cache, key, res, lifetime)
+            index.add(cache, key, tags)
+            return res
+        finally:
+            # Errors are raised to every awaiter of the task but never cached
+            del tasks[task_key]
+
+    @functools.wraps(wrapped_func)
+    async def wrapper_func(*args: Any, **kwargs: Any) -> Any:
+        if kwargs or len(args) != arity:
+            try:
+                key = build_key(*args, **kwargs)
+            except TypeError:
+                # The arguments do not match the signature, let the function raise its own error
+                return await direct(*args, **kwargs)
+        else:
+            key = args
+        try:
+            res = cache.get(key, _MISSING)
+        except TypeError:
+            # Unhashable arguments are looked up by their fingerprint
+            try:
+                key = _fingerprint(key)
+            except TypeError:
+                # Fall back to calling the function directly if arguments cannot be fingerprinted
+                return await direct(*args, **kwargs)
+            res = cache.get(key, _MISSING)
+        if res is not _MISSING:
             return res
+
+        task_key = (asyncio.get_running_loop(), key)
+        task = tasks.get(task_key)
+        if task is None:
+            task = tasks[task_key] = asyncio.ensure_future(call(task_key, args, kwargs))
+        return await asyncio.shield(task)
+
+    return _attach(wrapper_func, cache, index, build_key, tier=tier)
+
+class _CachedMethod(object):
+    """
+    A descriptor giving each instance its own cached version of a method. The cached versions are kept by instance id
+    and dropped by a finalizer when their instance is collected. They only hold a weak reference to their instance, so
+    caching never keeps an instance alive. The signature is analysed once for all instances, which share the key
+    builder and the stripe locks of single-flight calls, and only get their own cache.
+    """
+
+    def __init__(self, method: Callable[..., Any], **options: Any) -> None:
+        self._method = method
+        self._options = options
+        self._caches: Dict[int, Callable[..., Any]] = {}
+        self._lock = threading.Lock()
+        signature = inspect.signature(method)
+        # The cached versions are called without self
+        self._signature = signature.replace(parameters=list(signature.parameters.values())[1:])
+        self._build_key, self._arity = _key_builder(self._signature)
+        self._stripes = [threading.Lock() for _ in range(_STRIPES)] if options['thread_safe'] else None
+        functools.update_wrapper(self, method)
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+        cached = self._caches.get(id(instance))
+        if cached is None:
+            cached = self._cache_for(instance)
+        return cached
+
+    def _cache_for(self, instance: Any) -> Callable[..., Any]:
+        method = self._method
+        ref = weakref.ref(instance)
+        if inspect.iscoroutinefunction(method):
+            async def bound(*args: Any, **kwargs: Any) -> Any:
+                return await method(ref(), *args, **kwargs)
+        else:
+            def bound(*args: Any, **kwargs: Any) -> Any:
+                return method(ref(), *args, **kwargs)
+        functools.update_wrapper(bound, method)
+        bound.__signature__ = self._signature
+        cached = _cached(bound, self._build_key, self._arity, stripes=self._stripes, **self._options)
+        with self._lock:
+            if id(instance) not in self._caches:
+                self._caches[id(instance)] = cached
+                weakref.finalize(instance, self._caches.pop, id(instance), None)
+            return self._caches[id(instance)]
+
+    def __call__(self, instance: Any, *args: Any, **kwargs: Any) -> Any:
+        # Called through the class, as in Class.method(obj, ...)
+        return self.__get__(instance)(*args, **kwargs)
+
+def cache_batch(
+    wrapped_func: Optional[Callable[..., Any]] = None,
+    *,
+    maxsize: Optional[int] = None,
+    policy: str = 'lru',
+    ttl: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    expire_on: Optional[str] = None,
+) -> Callable[..., List[Any]]:
+    """
+    A decorator that caches the results of a function taking a batch of items as its first argument, item by item.
+    Each call looks its items up in the cache, calls the function once with only the missing items, and returns the
+    results of all the items in their order. The function returns either a sequence of results in the order of the
+    items it was given, or a mapping of item to result.
+
+    Args:
+        wrapped_func: The function to be wrapped with caching functionality.
+        maxsize: The maximum number of item results kept, unbounded by default.
+        policy: Which result to evict once a bound is reached, 'lru' or 'lfu'.
+        ttl: The number of seconds after which a result expires.
+        max_bytes: The maximum estimated size of the results kept.
+        expire_on: An exchange and a session event, such as 'XNYS:close', at the next occurrence of which results expire.
+
+    Returns:
+        A wrapped function returning a list of results, or a decorator when called with options only.
+
+    The wrapped function includes a reset_cache() method to clear the cache, and an invalidate(key=...) method to remove
+    the result stored under the key returned by its cache_key(item, *args, **kwargs) method, which takes a single item
+    in place of the batch. The other arguments are part of the key of every item, so fetch_prices(ids, date) caches
+    each (id, date) pair.
+
+    Example:
+    >>> @cache_batch(maxsize=100_000)
+    ... def fetch_prices(ids, date):
+    ...     return backend.prices(ids, date)
+    >>> fetch_prices(['IBM', 'MSFT'], today)
+    >>> fetch_prices(['MSFT', 'AAPL'], today)  # Only fetches AAPL
+    """
+    if policy not in _POLICIES:
+        raise ValueError('Unknown cache policy {!r}, expected one of {}'.format(policy, ', '.join(_POLICIES)))
+    if expire_on is not None:
+        _parse_expire_on(expire_on)
+    if wrapped_func is None:
+        return functools.partial(
+            cache_batch, maxsize=maxsize, policy=policy, ttl=ttl, max_bytes=max_bytes, expire_on=expire_on
+        )
+
+    parameters = list(inspect.signature(wrapped_func).parameters.values())
+    if not parameters or parameters[0].kind not in (parameters[0].POSITIONAL_ONLY, parameters[0].POSITIONAL_OR_KEYWORD):
+        raise ValueError('{} must take its batch of items as its first parameter'.format(wrapped_func.__qualname__))
+    batch_name = parameters[0].name
+    build_key, _ = _key_builder(inspect.signature(wrapped_func))
+    if maxsize is None and ttl is None and max_bytes is None and expire_on is None:
+        cache: Any = {}
+    else:
+        cache = _POLICIES[policy](maxsize, ttl, max_bytes, expire_on)
+    # Batch results carry no tags, the index only serves invalidate(key=...)
+    tag_index = _TagIndex(None)
+    if not isinstance(cache, dict):
+        cache.on_remove = tag_index.discard
+
+    def lookup(key: tuple) -> Tuple[Optional[Hashable], Any]:
+        try:
+            return key, cache.get(key, _MISSING)
+        except TypeError:
+            try:
+                key = _fingerprint(key)
+            except TypeError:
+                # This item is computed but not cached
+                return None, _MISSING
+            return key, cache.get(key, _MISSING)
+
+    @functools.wraps(wrapped_func)
+    def wrapper_func(*args: Any, **kwargs: Any) -> List[Any]:
+        try:
+            full_key = build_key(*args, **kwargs)
         except TypeError:
-            # Fall back to calling the function directly if arguments are unhashable
+            # The arguments do not match the signature, let the function raise its own error
             return wrapped_func(*args, **kwargs)
+        items: List[Any] = list(full_key[0])
+        rest = full_key[1:]
 
-    # Type declaration for cache
-    wrapper_func._results_cache = {} 
+        results: List[Any] = [_MISSING] * len(items)
+        # The positions of each missing key, in the order the items were first met
+        missing: Dict[Hashable, List[int]] = {}
+        missing_items: List[Any] = []
+        for index, item in enumerate(items):
+            key, res = lookup((item,) + rest)
+            if res is not _MISSING:
+                results[index] = res
+                continue
+            if key is None:
+                key = _Uncached()
+            positions = missing.get(key)
+            if positions is None:
+                missing[key] = [index]
+                missing_items.append(item)
+            else:
+                positions.append(index)
 
-    def reset_cache() -> None:
-        """Clears the cache of stored results."""
-        wrapper_func._results_cache.clear()
+        if missing:
+            if args:
+                computed = wrapped_func(missing_items, *args[1:], **kwargs)
+            else:
+                computed = wrapped_func(**dict(kwargs, **{batch_name: missing_items}))
+            values = _scatter_values(computed, missing_items, wrapped_func)
+            for (key, positions), value in zip(missing.items(), values):
+                if not isinstance(key, _Uncached):
+                    cache[key] = value
+                for index in positions:
+                    results[index] = value
+        return results
 
-    wrapper_func.reset_cache = reset_cache
-    return wrapper_func
\ No newline at end of file
+    def item_key(item: Any, *args: Any, **kwargs: Any) -> tuple:
+        # The key of a single item, given in place of the batch
+        return (item,) + build_key([item], *args, **kwargs)[1:]
+
+    return _attach(wrapper_func, cache, tag_index, item_key)
+
+class _Uncached(object):
+    """Stands for the key of a batch item that cannot be cached, each one distinct."""
+
+def _scatter_values(computed: Any, items: List[Any], wrapped_func: Callable[..., Any]) -> Iterable[Any]:
+    """Returns the results computed for items in their order, from a mapping or a sequence."""
+    if isinstance(computed, Mapping):
+        return [computed[item] for item in items]
+    values = list(computed)
+    if len(values) != len(items):
+        raise ValueError('{} returned {} results for {} items'.format(wrapped_func.__qualname__, len(values), len(items)))
+    return values
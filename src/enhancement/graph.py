@@ -1,16 +1,51 @@
 import contextlib
+import json
+import mmap
+import pickle
+import struct
 import sys
+import tempfile
 import time
-from collections import defaultdict
-from threading import current_thread
+import weakref
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, RLock, current_thread, local
+from xml.sax.saxutils import escape
 import networkx as nx
-import matplotlib.pyplot as plt
+from ._sizing import _estimate_size
+from .result_store import stable_hash
 
 class CLEAR(object):
   """Placeholder to use for a cleared value"""
 
 CLEAR = CLEAR()
 
+# The last notified value of a vertex whose subscribers were never notified in any state on the stack
+_NOT_NOTIFIED = object()
+
+class CancellationToken(object):
+    """A flag that can be raised from any thread to abort the evaluations running under it"""
+
+    def __init__(self):
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+class EvaluationAborted(RuntimeError):
+    """
+    Raised when an evaluation runs past its deadline or gets cancelled. The payloads evaluated before the abort stay valid,
+    so asking for the same vertex again resumes the work, and stats reports how far the evaluation got
+    """
+
+    def __init__(self, message, stats):
+        super(EvaluationAborted, self).__init__(message)
+        self.stats = stats
+
 class GraphState(dict):
     """
     A PayloadCache holds a mapping of Vertex to VertexPayload representing a particular state of this graph
@@ -22,25 +57,179 @@ class GraphState(dict):
         self._depth = GraphState._next_depth
         GraphState._next_depth += 1
         self._graph = graph
-        self._active_child = None
+        # Each thread evaluating against this state tracks its own active child
+        self._local = local()
+        # The vertices whose payload changed since the state was entered, for states that track them
+        self._written = None
+        # The values subscribers were last notified of for writes to this state
+        self._notified_values = {}
 
     def __del__(self):
         GraphState._next_depth -= 1
 
     @property
     def active_child(self):
-        return self._active_child
+        return getattr(self._local, 'active_child', None)
 
     @active_child.setter
     def active_child(self, value):
-        self._active_child = value
+        self._local.active_child = value
 
     def copy(self, other=None):
         if other is None:
             other = GraphState(self._graph)
-        other.update({vx_id: vx.clone(other) for vx_id, vx in self.items()})
+        # Copied from a list of the items, as other threads may add payloads to a shared root meanwhile
+        other.update({vx_id: vx.clone(other) for vx_id, vx in list(self.items())})
+        self._graph._payload_copies += len(self)
         return other
 
+    def snapshot(self, path):
+        """
+        Write the fixed values, the valid derived values and the edges of this state to path, keyed by GraphVertex.stable_id.
+        Values that cannot be pickled or whose stable_id is not unique are left out together with their descendants,
+        which are then recomputed after a restore.
+        """
+        vertices = {}
+        ambiguous = set()
+        for vertex in self:
+            for other in (vertex,) + tuple(vertex.children):
+                if vertices.setdefault(other.stable_id, other) is not other:
+                    ambiguous.add(other.stable_id)
+
+        entries = []
+        # Every vertex sharing an ambiguous stable_id is left out, not only the first one met
+        excluded = {
+            other
+            for vertex in self for other in (vertex,) + tuple(vertex.children)
+            if other.stable_id in ambiguous
+        }
+        with open(path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, 0))
+            for vertex, payload in self.items():
+                if not payload.is_valid() or vertex.stable_id in ambiguous:
+                    continue
+                try:
+                    data = pickle.dumps(payload.value, pickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    if payload.is_fixed():
+                        raise
+                    excluded.add(vertex)
+                    continue
+                entries.append((vertex, payload.flags & (VertexPayload.FIXED | VertexPayload.VALID), f.tell(), len(data)))
+                f.write(data)
+
+            for vertex in list(excluded):
+                excluded.update(self._graph.descendants(vertex))
+
+            index = {
+                'payloads': [(vertex.stable_id, flags, offset, length) for vertex, flags, offset, length in entries if vertex not in excluded],
+                'edges': [
+                    (vertex.stable_id, child.stable_id)
+                    for vertex in self for child in vertex.children
+                    if vertex.stable_id not in ambiguous and child.stable_id not in ambiguous
+                ],
+            }
+            index_offset = f.tell()
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, index_offset))
+
+    def restore(self, path, objects=None):
+        """
+        Restore a snapshot written by snapshot() into this state, matching vertices of objects (by default every live GraphObject) by stable_id.
+        The file is memory-mapped and each value is only unpickled when first read. Returns the number of restored payloads.
+        """
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset = _SNAPSHOT_HEADER.unpack_from(buffer, 0)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise RuntimeError('{} is not a GraphState snapshot'.format(path))
+        index = pickle.loads(buffer[index_offset:])
+
+        if objects is None:
+            find_vertex = self._graph._find_vertex
+        else:
+            vertices = _vertices_by_stable_id(objects)
+            find_vertex = vertices.get
+
+        restored = 0
+        with self._graph._writing():
+            for parent_id, child_id in index['edges']:
+                parent, child = find_vertex(parent_id), find_vertex(child_id)
+                if parent is not None and child is not None and child not in parent.children:
+                    parent.children.add(child)
+                    child.parents.add(parent)
+            self._graph._edges_changed()
+
+            restored_vertices = [find_vertex(stable_id) for stable_id, _, _, _ in index['payloads']]
+            for vertex in restored_vertices:
+                # Values derived in this state from the payloads being replaced would otherwise stay valid
+                if vertex is not None and vertex in self:
+                    self._graph._invalidate_children(vertex, self)
+
+            for vertex, (_, flags, offset, length) in zip(restored_vertices, index['payloads']):
+                if vertex is not None:
+                    self[vertex] = VertexPayload(vertex, self, flags | VertexPayload.DEFERRED, _MappedValue(buffer, offset, length))
+                    if self._written is not None:
+                        self._written.add(vertex)
+                    restored += 1
+        return restored
+
+    def diff(self, other, vertices=None):
+        """
+        Compare the payloads of this state with those of other, optionally only for the given vertices.
+        Returns three dicts: changed {vertex: (value, other value)}, added {vertex: other value} and removed {vertex: value}.
+        A payload is changed when its fixed flag or the identity of its value differ. Invalid and missing payloads count as absent.
+        When both states are scopes entered from a common state, only the vertices they wrote since are compared.
+        """
+        if vertices is None:
+            vertices = self._written_since_common_state(other)
+            if vertices is None:
+                vertices = set(self)
+                vertices.update(other)
+
+        valid, fixed = VertexPayload.VALID, VertexPayload.FIXED
+        changed, added, removed = {}, {}, {}
+        for vertex in vertices:
+            payload = self.get(vertex)
+            other_payload = other.get(vertex)
+            if payload is not None and not payload._flags & valid:
+                payload = None
+            if other_payload is not None and not other_payload._flags & valid:
+                other_payload = None
+
+            if payload is None:
+                if other_payload is not None:
+                    added[vertex] = other_payload.value
+            elif other_payload is None:
+                removed[vertex] = payload.value
+            elif payload._value is not other_payload._value or (payload._flags ^ other_payload._flags) & fixed:
+                changed[vertex] = (payload.value, other_payload.value)
+        return changed, added, removed
+
+    def _written_since_common_state(self, other):
+        # Walk both chains of entered scopes up to the closest state they share, None when some state on the way does not track its writes
+        ancestors = []
+        graph_state = self
+        while graph_state is not None:
+            ancestors.append(graph_state)
+            graph_state = getattr(graph_state, '_parent_state', None)
+
+        other_path = []
+        graph_state = other
+        while graph_state is not None and graph_state not in ancestors:
+            other_path.append(graph_state)
+            graph_state = getattr(graph_state, '_parent_state', None)
+        if graph_state is None:
+            return None
+
+        vertices = set()
+        for graph_state in ancestors[:ancestors.index(graph_state)] + other_path:
+            if graph_state._written is None:
+                return None
+            vertices.update(graph_state._written)
+        return vertices
+
     def __hash__(self):
         return id(self)
     
@@ -54,6 +243,28 @@ class Graph(object):
         self._gather_performance = False
         self._timings = defaultdict(list)
         self._nx_graph = nx.DiGraph()  # Initialize NetworkX directed graph
+        self._subscriptions = {}
+        self._pending_notifications = set()
+        self._batch_depth = 0
+        self._closures = {}
+        self._upstreams = {}
+        self._vertex_indices = {}
+        self._ancestor_bits = {}
+        self._descendant_bits = {}
+        self._path_counts = {}
+        self._objects = weakref.WeakSet()
+        self._stable_ids = weakref.WeakValueDictionary()
+        self._stable_ids_size = None
+        self._shared_results = None
+        self._shared_maxsize = 0
+        # How the parents of the last evaluation of each pure function were reached from its GraphObject
+        self._shared_parents = {}
+        self._shared_hits = defaultdict(int)
+        self._spill = None
+        # The deadline and cancellation token of the evaluation running on each thread
+        self._budgets = local()
+        self._concurrency = None
+        self.reset_metrics()
 
     def is_calculating(self):
         # Check if any vertex in the current state stack is being calculated
@@ -68,6 +279,90 @@ class Graph(object):
 
     def reset_timings(self):
         self._timings = defaultdict(list)
+        self._shared_hits = defaultdict(int)
+
+    @property
+    def shared_hits(self):
+        """The number of evaluations of each pure vertex id saved by structural sharing"""
+        return self._shared_hits
+
+    @property
+    def is_sharing(self):
+        return self._shared_results is not None
+
+    def enable_sharing(self, maxsize=4096):
+        """
+        Share the results of pure vertices across GraphObject instances: a pure vertex whose function and parents' values
+        match a recent evaluation, from any instance, reuses its result. Up to maxsize results are kept, least recently used first out.
+        """
+        self._shared_results = OrderedDict()
+        self._shared_maxsize = maxsize
+
+    def disable_sharing(self):
+        self._shared_results = None
+
+    @property
+    def is_concurrent(self):
+        return self._concurrency is not None
+
+    def enable_concurrency(self, stripes=64):
+        """
+        Let threads that have not used the graph yet share the root GraphState of the calling thread. Valid payloads are
+        read without locking, while a thread asking for a payload another thread is evaluating waits for that result
+        instead of evaluating it again. Evaluations that a write reaches while they run return their result without caching it.
+        """
+        if self._concurrency is not None:
+            raise RuntimeError('Concurrency is already enabled')
+        root = self._state_stack[0]
+        self._concurrency = _Concurrency(stripes)
+        self._state_stacks.default_factory = lambda: [root]
+
+    def disable_concurrency(self):
+        """Give threads that have not used the graph yet their own root GraphState again"""
+        self._concurrency = None
+        self._state_stacks.default_factory = lambda: [GraphState(self)]
+
+    def _writing(self):
+        """Serialize a write with the other writes and evaluations committing their result, in concurrent mode"""
+        if self._concurrency is None:
+            return contextlib.nullcontext()
+        return self._concurrency.writing()
+
+    def enable_spill(self, threshold=1 << 20, budget=1 << 30, directory=None):
+        """
+        Keep at most budget bytes of values weighing threshold bytes or more resident. Past the budget, the least recently
+        used of those values are pickled to a temporary memory-mapped file in directory and read back when next accessed.
+        """
+        self._spill = _ValueSpill(threshold, budget, directory)
+
+    def disable_spill(self):
+        """Stop spilling new values, the values already spilled are still read back from their file"""
+        self._spill = None
+
+    @property
+    def spill_stats(self):
+        return self._spill.stats if self._spill is not None else {}
+
+    def reset_metrics(self):
+        # Plain counters, cheap enough to always be on, so increments from concurrent threads may occasionally be lost
+        self._evaluations = 0
+        self._cache_hits = 0
+        self._invalidations = 0
+        self._set_value_calls = 0
+        self._diddle_enters = 0
+        self._payload_copies = 0
+
+    def metrics(self):
+        """Return a snapshot of the graph counters along with the payload count of each state, per thread"""
+        return {
+            'evaluations': self._evaluations,
+            'cache_hits': self._cache_hits,
+            'invalidations': self._invalidations,
+            'set_value_calls': self._set_value_calls,
+            'diddle_enters': self._diddle_enters,
+            'payload_copies': self._payload_copies,
+            'payloads': {thread.name: [len(state) for state in stack] for thread, stack in list(self._state_stacks.items())},
+        }
 
     @property
     def is_debug_mode(self):
@@ -107,43 +402,416 @@ class Graph(object):
             raise RuntimeError('Cannot pop the root state')
         return self._state_stack.pop()
 
-    def get_value(self, vertex):
+    def get_value(self, vertex, deadline=None, token=None):
+        """
+        Return the value of vertex, evaluating it if needed. With a deadline, a time.monotonic() timestamp, or a
+        CancellationToken, EvaluationAborted is raised before the next vertex evaluation once the deadline passed or
+        the token got cancelled
+        """
+        if deadline is not None or token is not None:
+            return self._get_value_within(vertex, deadline, token)
+
         # If there is a valid active child, add a directed edge
         active_child = self.active_state.active_child
-        if active_child:
-            if vertex not in active_child.parents:
+        concurrency = self._concurrency
+        if active_child and active_child not in vertex.children:
+            if concurrency is None:
                 active_child.parents.add(vertex)
-            if active_child not in vertex.children:
                 vertex.children.add(active_child)
+                self._edges_changed()
+            else:
+                concurrency.add_edge(vertex, active_child)
         
         payload = self.active_state.get(vertex)
         if payload is None:
             payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-        if payload.is_valid():
-            return payload.value
-
+        if concurrency is None:
+            if payload.is_valid():
+                self._cache_hits += 1
+                return payload.value
+        else:
+            value = concurrency.read(payload)
+            if value is not _INVALID:
+                self._cache_hits += 1
+                return value
+
+        budget = getattr(self._budgets, 'current', None)
+        if budget is not None:
+            budget.check(vertex)
+
+        flight = None
+        if concurrency is not None:
+            flight = concurrency.acquire(payload, budget)
+            if flight.owner is not current_thread():
+                # Another thread evaluated this payload, its result is used rather than evaluating it twice
+                self._cache_hits += 1
+                return flight.value
+
+        self._evaluations += 1
         saved_child = active_child
         try:
             self.active_state.active_child = vertex
             with self.time_it(vertex):
-                payload.value = vertex.evaluate()
+                if vertex._store is not None:
+                    value = self._evaluate_stored(vertex)
+                elif vertex._pure and self._shared_results is not None:
+                    value = self._evaluate_shared(vertex)
+                else:
+                    value = vertex.evaluate()
                 # Ensure vertex is added to graph when evaluated
-                self._nx_graph.add_node(vertex._id, value=payload.value)
+                self._nx_graph.add_node(vertex._id)
+            if flight is None:
+                payload.value = value
+                if self._spill is not None:
+                    self._spill.track(payload)
+            else:
+                concurrency.commit(payload, flight, value, self._spill)
+            written = payload._graph_state._written
+            if written is not None:
+                written.add(vertex)
+            if budget is not None:
+                budget.evaluated += 1
+        except BaseException as error:
+            if flight is not None:
+                concurrency.fail(payload, flight, error)
+            raise
         finally:
             self.active_state.active_child = saved_child
         
-        return payload.value
+        return value
+
+    def _get_value_within(self, vertex, deadline, token):
+        saved = getattr(self._budgets, 'current', None)
+        budget = _EvaluationBudget(deadline, token)
+        if saved is not None:
+            # A nested budget can only be tighter than the one it runs under
+            if saved.deadline is not None and (deadline is None or saved.deadline < deadline):
+                budget.deadline = saved.deadline
+            budget.tokens = saved.tokens + budget.tokens
+        self._budgets.current = budget
+        try:
+            return self.get_value(vertex)
+        finally:
+            if saved is not None:
+                saved.evaluated += budget.evaluated
+            self._budgets.current = saved
+
+    def _edges_changed(self):
+        self._closures.clear()
+        self._upstreams.clear()
+        self._vertex_indices.clear()
+        self._ancestor_bits.clear()
+        self._descendant_bits.clear()
+        self._path_counts.clear()
+
+    def _downstream(self, vertex):
+        """Return the descendants of vertex in topological order, cached until an edge is added to the graph"""
+        closure = self._closures.get(vertex)
+        if closure is None:
+            closure = self._closures[vertex] = _topological_closure(vertex, 'children')
+        return closure
+
+    def _find_vertex(self, stable_id):
+        # The id lookup is rebuilt lazily whenever GraphObjects were created or collected since the last build
+        vertex = self._stable_ids.get(stable_id)
+        if vertex is None and self._stable_ids_size != len(self._objects):
+            self._stable_ids = weakref.WeakValueDictionary(_vertices_by_stable_id(list(self._objects)))
+            self._stable_ids_size = len(self._objects)
+            vertex = self._stable_ids.get(stable_id)
+        return vertex
+
+    def _upstream(self, vertex):
+        """Return the ancestors of vertex in reverse topological order, cached until an edge is added to the graph"""
+        closure = self._upstreams.get(vertex)
+        if closure is None:
+            closure = self._upstreams[vertex] = _topological_closure(vertex, 'parents')
+        return closure
+
+    def _reachability_bits(self, vertex, closure, index):
+        # A bytearray bitset over the vertex indices of the closure, so that membership is a single byte lookup
+        bits = index.get(vertex)
+        if bits is None:
+            vertex_indices = self._vertex_indices
+            positions = [vertex_indices.setdefault(other, len(vertex_indices)) for other in closure]
+            bits = index[vertex] = bytearray((len(vertex_indices) + 7) >> 3)
+            for position in positions:
+                bits[position >> 3] |= 1 << (position & 7)
+        return bits
+
+    def _is_in(self, vertex, bits):
+        position = self._vertex_indices.get(vertex)
+        return position is not None and position >> 3 < len(bits) and bool(bits[position >> 3] & (1 << (position & 7)))
+
+    def ancestors(self, vertex, inputs_only=False):
+        """Return the vertices vertex depends on in topological order, optionally only those without parents"""
+        closure = self._upstream(vertex)[::-1]
+        if inputs_only:
+            return tuple(other for other in closure if not other.parents)
+        return closure
+
+    def descendants(self, vertex, outputs_only=False):
+        """Return the vertices depending on vertex in topological order, optionally only those without children"""
+        closure = self._downstream(vertex)
+        if outputs_only:
+            return tuple(other for other in closure if not other.children)
+        return closure
+
+    def depends_on(self, vertex, other):
+        """Check whether vertex depends, directly or not, on other"""
+        return self._is_in(other, self._reachability_bits(vertex, self._upstream(vertex), self._ancestor_bits))
+
+    def affects(self, vertex, other):
+        """Check whether other depends, directly or not, on vertex"""
+        return self._is_in(other, self._reachability_bits(vertex, self._downstream(vertex), self._descendant_bits))
+
+    def count_paths(self, source, target):
+        """Count the distinct paths going from source to target"""
+        key = (source, target)
+        count = self._path_counts.get(key)
+        if count is None:
+            count = 0
+            if self.depends_on(target, source):
+                ancestor_bits = self._reachability_bits(target, self._upstream(target), self._ancestor_bits)
+                counts = {source: 1}
+                for vertex in self._downstream(source):
+                    if vertex is not target and not self._is_in(vertex, ancestor_bits):
+                        continue
+                    counts[vertex] = sum(counts.get(parent, 0) for parent in vertex.parents)
+                    if vertex is target:
+                        count = counts[vertex]
+                        break
+            self._path_counts[key] = count
+        return count
+
+    def _evaluate_stored(self, vertex):
+        """
+        Look the vertex up in its ResultStore before evaluating it. Results are keyed by the stable_id of the vertex and
+        the hashes of its parents' values, the parents being those recorded by the store the last time the vertex was evaluated.
+        """
+        store = vertex._store
+        stable_id = vertex.stable_id
+        parent_ids = store.peek(stable_id)
+        parents = None
+        if parent_ids is not None:
+            # Parents on the vertex's own object are resolved first, then among every live GraphObject
+            own_vertices = _vertices_by_stable_id([vertex._obj])
+            parents = [own_vertices.get(parent_id) or self._find_vertex(parent_id) for parent_id in parent_ids]
+        if parents is None or None in parents:
+            parents = sorted(vertex.parents, key=lambda parent: parent.stable_id)
+
+        key = self._stored_key(stable_id, parents)
+        if key is not None:
+            value = store.get(key, CLEAR)
+            if value is not CLEAR:
+                return value
+
+        value = vertex.evaluate()
+        parents = sorted(vertex.parents, key=lambda parent: parent.stable_id)
+        key = self._stored_key(stable_id, parents)
+        if key is not None:
+            store.put(stable_id, tuple(parent.stable_id for parent in parents))
+            store.put(key, value)
+        return value
 
-    def _invalidate_children(self, vertex):
-        children = set(vertex.children)
-        while children:
-            child = children.pop()
+    def _stored_key(self, stable_id, parents):
+        # Reading the parents from within the evaluation of the vertex records their edges, even when the store hits
+        parent_values = [(parent.stable_id, self.get_value(parent)) for parent in parents]
+        try:
+            return stable_hash((stable_id, parent_values))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
 
-            payload = self.active_state.get(child)
-            if payload is not None and not payload.is_fixed() and payload.is_valid():
-                payload.invalidate()
-                children.update(child.children)
+    def _evaluate_shared(self, vertex):
+        # The first evaluation of a vertex is what discovers its parents, until then they are predicted from those of
+        # the last evaluation of the same function on another instance
+        parents = vertex.parents or self._predicted_parents(vertex)
+        key = None if parents is None else self._shared_key(vertex, parents)
+        if key is not None:
+            value = self._shared_results.get(key, CLEAR)
+            if value is not CLEAR:
+                self._shared_results.move_to_end(key)
+                self._shared_hits[vertex._id] += 1
+                return value
+
+        value = vertex.evaluate()
+        self._shared_parents[vertex._func] = self._parent_paths(vertex)
+        key = self._shared_key(vertex, vertex.parents)
+        if key is not None:
+            self._shared_results[key] = value
+            if len(self._shared_results) > self._shared_maxsize:
+                self._shared_results.popitem(last=False)
+        return value
+
+    def _parent_paths(self, vertex):
+        # Each parent is a vertex of the vertex's own object (None), or of an object held by one of its attributes
+        obj = vertex._obj
+        attributes = {id(value): name for name, value in vars(obj).items()}
+        paths = []
+        for parent in vertex.parents:
+            attribute = None
+            if parent._obj is not obj:
+                attribute = attributes.get(id(parent._obj))
+                if attribute is None:
+                    return None
+            paths.append((attribute, parent._func.__name__))
+        return paths
+
+    def _predicted_parents(self, vertex):
+        paths = self._shared_parents.get(vertex._func)
+        if paths is None:
+            return None
+        parents = []
+        for attribute, name in paths:
+            obj = vertex._obj if attribute is None else getattr(vertex._obj, attribute, None)
+            parent = getattr(obj, '__dict__', {}).get(name)
+            if not isinstance(parent, GraphVertex) or parent._obj is not obj:
+                return None
+            parents.append(parent)
+        return parents
+
+    def _shared_key(self, vertex, parents):
+        # A parent's role is its class and function, roles must be unique for the parents' values to be told apart
+        parent_values = {(type(parent._obj), parent._func): self.get_value(parent) for parent in parents}
+        if len(parent_values) != len(parents):
+            return None
+        key = (vertex._func, frozenset(parent_values.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _invalidate_children(self, vertex, state=None):
+        if state is None:
+            state = self.active_state
+        valid, fixed = VertexPayload.VALID, VertexPayload.FIXED
+
+        # Evaluations in progress may have read the previous values, only their results are dropped rather than all
+        concurrency = self._concurrency
+        evaluating = concurrency is not None and concurrency.evaluating()
+        if evaluating:
+            concurrency.mark_stale(state.get(vertex))
+
+        # Nothing downstream can be valid if no direct child is, nor being evaluated
+        for child in vertex.children:
+            payload = state.get(child)
+            if payload is not None and payload._flags & (valid | fixed) == valid:
+                break
+        else:
+            if not evaluating:
+                return
+
+        # Subscribers are notified of the values of the active state only
+        subscriptions = self._subscriptions if state is self.active_state else None
+        written = state._written
+        blocked = False
+        for child in self._downstream(vertex):
+            payload = state.get(child)
+            if payload is None:
+                continue
+            flags = payload._flags
+            if flags & fixed:
+                # A fixed vertex shields its descendants, from here on only vertices with an invalidated parent are reached
+                blocked = True
+                continue
+            if not flags & valid:
+                if evaluating and (not blocked or _has_invalid_parent(child, vertex, state)):
+                    concurrency.mark_stale(payload)
+                continue
+            if blocked and not _has_invalid_parent(child, vertex, state):
+                continue
+            payload.invalidate()
+            self._invalidations += 1
+            if written is not None:
+                written.add(child)
+            if subscriptions and child in subscriptions:
+                self._pending_notifications.add(child)
+
+    def subscribe(self, vertex, callback):
+        """
+        Call callback with a {vertex: value} dict of the subscribed vertices whose value changed after each write batch.
+        The vertex is evaluated once here so that later writes can reach it through its edges.
+        """
+        if self.is_calculating():
+            raise RuntimeError('Cannot subscribe while the graph is updating its state')
+
+        callbacks = self._subscriptions.get(vertex)
+        if callbacks is None:
+            self.active_state._notified_values[vertex] = self.get_value(vertex)
+            callbacks = self._subscriptions[vertex] = []
+        callbacks.append(callback)
+
+    def unsubscribe(self, vertex, callback):
+        callbacks = self._subscriptions.get(vertex)
+        if not callbacks or callback not in callbacks:
+            raise RuntimeError('Cannot unsubscribe a callback that has not been subscribed')
+
+        callbacks.remove(callback)
+        if not callbacks:
+            del self._subscriptions[vertex]
+            for state in self._state_stack:
+                state._notified_values.pop(vertex, None)
+            self._pending_notifications.discard(vertex)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group the writes of a with block so that subscribers are notified once on exit"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._pending_notifications:
+                self._notify_subscribers()
+
+    def _after_write(self, vertex):
+        written = self.active_state._written
+        if written is not None:
+            written.add(vertex)
+        if vertex in self._subscriptions:
+            self._pending_notifications.add(vertex)
+        if self._pending_notifications and not self._batch_depth:
+            self._notify_subscribers()
+
+    def _notify_subscribers(self):
+        # Only subscribed vertices invalidated by the batch are recomputed, each callback is then called once
+        pending, self._pending_notifications = self._pending_notifications, set()
+        changes = {}
+        for vertex in pending:
+            callbacks = self._subscriptions.get(vertex)
+            if not callbacks:
+                continue
+            value = self.get_value(vertex)
+            if value != self._last_notified(vertex):
+                self.active_state._notified_values[vertex] = value
+                for callback in callbacks:
+                    changes.setdefault(callback, {})[vertex] = value
+        for callback, changed in changes.items():
+            callback(changed)
     
+    def _notify_reverted(self, notified):
+        # The subscribers notified of values inside an exited scope are told the values of the state it returned to
+        changes = {}
+        for vertex, scoped_value in notified.items():
+            callbacks = self._subscriptions.get(vertex)
+            if not callbacks:
+                continue
+            value = self.get_value(vertex)
+            if value != scoped_value:
+                self.active_state._notified_values[vertex] = value
+                for callback in callbacks:
+                    changes.setdefault(callback, {})[vertex] = value
+        for callback, changed in changes.items():
+            callback(changed)
+
+    def _last_notified(self, vertex):
+        # A scope starts from the values notified for the states it was entered from
+        for state in reversed(self._state_stack):
+            value = state._notified_values.get(vertex, _NOT_NOTIFIED)
+            if value is not _NOT_NOTIFIED:
+                return value
+        return _NOT_NOTIFIED
+
     def is_fixed(self, vertex):
         if vertex in self.active_state and self.is_calculating():
             raise RuntimeError('Graph cannot be modified while its updating its state')
@@ -155,6 +823,7 @@ class Graph(object):
         return payload.is_fixed()
 
     def set_value(self, vertex, value):
+        self._set_value_calls += 1
         if self.is_calculating():
             raise RuntimeError('Graph cannot be modified while its updating its state')
         
@@ -165,10 +834,16 @@ class Graph(object):
             if payload is None:
                 payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
             
-            if not payload.is_fixed() or payload.value != value:
-                payload.fix_value(value)
-                self._invalidate_children(vertex)
-            return payload.value
+            with self._writing():
+                changed = not payload.is_fixed() or payload.value != value
+                if changed:
+                    payload.fix_value(value)
+                    if self._spill is not None:
+                        self._spill.track(payload)
+                    self._invalidate_children(vertex)
+            if changed:
+                self._after_write(vertex)
+            return value
 
     def clear_value(self, vertex):
         if vertex in self.active_state and self.is_calculating():
@@ -178,8 +853,10 @@ class Graph(object):
         if not payload or not payload.is_fixed():
             raise RuntimeError('Cannot clear a value that has not been set')
         
-        del self.active_state[vertex]
-        self._invalidate_children(vertex)
+        with self._writing():
+            del self.active_state[vertex]
+            self._invalidate_children(vertex)
+        self._after_write(vertex)
       
     def set_diddle(self, vertex, value):
         if vertex in self.active_state and self.is_calculating():
@@ -189,11 +866,16 @@ class Graph(object):
             raise RuntimeError('Cannot diddle value outside of a DiddleScope')
 
         payload = self.active_state.setdefault(vertex, VertexPayload(vertex, self.active_state))
-        if not payload.is_fixed() or payload.value != value:
-            payload._value = value
-            payload._flags |= (VertexPayload.FIXED | VertexPayload.VALID)
-            self._invalidate_children(vertex)
-        return payload.value
+        with self._writing():
+            changed = not payload.is_fixed() or payload.value != value
+            if changed:
+                payload.fix_value(value)
+                if self._spill is not None:
+                    self._spill.track(payload)
+                self._invalidate_children(vertex)
+        if changed:
+            self._after_write(vertex)
+        return value
       
     def clear_diddle(self, vertex):
         if vertex in self.active_state and self.is_calculating():
@@ -205,8 +887,10 @@ class Graph(object):
         if not payload or not payload.is_fixed():
             raise RuntimeError('Cannot clear a diddle that has not been set')
         
-        del self.active_state[vertex]
-        self._invalidate_children(vertex)
+        with self._writing():
+            del self.active_state[vertex]
+            self._invalidate_children(vertex)
+        self._after_write(vertex)
 
     def to_networkx(self):
         """Convert the current graph state to a NetworkX graph for analysis"""
@@ -224,15 +908,137 @@ class Graph(object):
         
         return self._nx_graph
 
-    def visualize(self, figsize=(10, 8), with_labels=True):
-        """Visualize the graph using NetworkX and matplotlib"""
-        plt.figure(figsize=figsize)
-        graph = self.to_networkx()
-        pos = nx.spring_layout(graph)
-        nx.draw(graph, pos, with_labels=with_labels, node_color='lightblue', 
-                node_size=1500, arrowsize=20)
+    def visualize(self, figsize=(10, 8), with_labels=True, around=None, depth=None):
+        """Visualize the graph with matplotlib, laid out in layers"""
+        import matplotlib.pyplot as plt
+
+        figure, axes = plt.subplots(figsize=figsize)
+        self._draw(axes, around, depth, with_labels)
         plt.show()
 
+    def render(self, path, figsize=(10, 8), with_labels=True, around=None, depth=None):
+        """Render the graph, laid out in layers, to an image file whose format (png, svg, pdf...) follows the path extension"""
+        # Drawing on a bare Figure needs neither pyplot nor a display
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize=figsize)
+        self._draw(figure.add_subplot(), around, depth, with_labels)
+        figure.savefig(path)
+
+    def _draw(self, axes, around, depth, with_labels):
+        vertices = self._export_vertices(around, depth)
+        layout = self.layered_layout(vertices)
+        for vertex in vertices:
+            for child in vertex.children:
+                if child in layout:
+                    axes.annotate('', xy=layout[child], xytext=layout[vertex], arrowprops=dict(arrowstyle='->', color='grey'))
+        if layout:
+            xs, ys = zip(*layout.values())
+            axes.scatter(xs, ys, s=300, c='lightblue', zorder=2)
+        if with_labels:
+            for vertex, (x, y) in layout.items():
+                axes.annotate(str(vertex), (x, y), ha='center', va='center', fontsize=8, zorder=3)
+        axes.invert_yaxis()
+        axes.set_axis_off()
+
+    def layered_layout(self, vertices=None):
+        """
+        Lay vertices (by default those with a payload in the active state) out in layers: the layer of a vertex is its depth
+        below the vertices it depends on, and within a layer vertices are ordered by the mean position of their parents.
+        Returns {vertex: (position in layer, layer)}.
+        """
+        if vertices is None:
+            vertices = list(self.active_state)
+        layout = {}
+
+        def barycenter(vertex):
+            positions = [layout[parent][0] for parent in vertex.parents if parent in layout]
+            return sum(positions) / len(positions) if positions else 0
+
+        for index, layer in enumerate(_topological_layers(set(vertices))):
+            layer.sort(key=lambda vertex: (barycenter(vertex), vertex.stable_id))
+            for position, vertex in enumerate(layer):
+                layout[vertex] = (position, index)
+        return layout
+
+    def export(self, path, format=None, around=None, depth=None):
+        """
+        Write the graph to path as 'dot', 'json' or 'graphml' (by default after the path extension), one vertex or edge at a time.
+        The vertices are those with a payload in the active state or, with around, those within depth edges of around
+        upstream and downstream (all of them when depth is None). JSON and GraphML carry a layered layout of the vertices.
+        """
+        if format is None:
+            format = str(path).rsplit('.', 1)[-1]
+        format = format.lower()
+        if format not in ('dot', 'json', 'graphml'):
+            raise ValueError('Cannot export a graph as {}'.format(format))
+
+        vertices = self._export_vertices(around, depth)
+        layout = self.layered_layout(vertices)
+        node_ids = {vertex: 'n{}'.format(index) for index, vertex in enumerate(vertices)}
+        edges = ((node_ids[vertex], node_ids[child]) for vertex in vertices for child in vertex.children if child in node_ids)
+        state = self.active_state
+
+        with open(path, 'w') as f:
+            if format == 'dot':
+                f.write('digraph {\n')
+                for vertex, node_id in node_ids.items():
+                    f.write('  {} [label={}];\n'.format(node_id, json.dumps(vertex.stable_id)))
+                for parent_id, child_id in edges:
+                    f.write('  {} -> {};\n'.format(parent_id, child_id))
+                f.write('}\n')
+            elif format == 'json':
+                f.write('{"nodes": [')
+                for index, (vertex, node_id) in enumerate(node_ids.items()):
+                    payload = state.get(vertex)
+                    node = {
+                        'id': node_id,
+                        'label': vertex.stable_id,
+                        'x': layout[vertex][0],
+                        'layer': layout[vertex][1],
+                        'valid': payload is not None and payload.is_valid(),
+                        'fixed': payload is not None and payload.is_fixed(),
+                    }
+                    f.write((', ' if index else '') + json.dumps(node))
+                f.write('], "edges": [')
+                for index, edge in enumerate(edges):
+                    f.write((', ' if index else '') + json.dumps(edge))
+                f.write(']}\n')
+            else:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+                f.write('  <key id="label" for="node" attr.name="label" attr.type="string"/>\n')
+                f.write('  <key id="x" for="node" attr.name="x" attr.type="int"/>\n')
+                f.write('  <key id="layer" for="node" attr.name="layer" attr.type="int"/>\n')
+                f.write('  <graph id="G" edgedefault="directed">\n')
+                for vertex, node_id in node_ids.items():
+                    f.write('    <node id="{}"><data key="label">{}</data><data key="x">{}</data><data key="layer">{}</data></node>\n'.format(
+                        node_id, escape(vertex.stable_id), layout[vertex][0], layout[vertex][1]))
+                for parent_id, child_id in edges:
+                    f.write('    <edge source="{}" target="{}"/>\n'.format(parent_id, child_id))
+                f.write('  </graph>\n</graphml>\n')
+
+    def _export_vertices(self, around, depth):
+        if around is None:
+            return list(self.active_state)
+        # Breadth first in both directions, so that depth counts edges from around
+        vertices = [around]
+        for attr in ('parents', 'children'):
+            seen = {around}
+            frontier = [around]
+            distance = 0
+            while frontier and (depth is None or distance < depth):
+                distance += 1
+                next_frontier = []
+                for vertex in frontier:
+                    for other in getattr(vertex, attr):
+                        if other not in seen:
+                            seen.add(other)
+                            next_frontier.append(other)
+                vertices.extend(next_frontier)
+                frontier = next_frontier
+        return list(dict.fromkeys(vertices))
+
     def get_cycles(self):
         """Detect cycles in the graph"""
         return list(nx.simple_cycles(self.to_networkx()))
@@ -270,9 +1076,405 @@ class Graph(object):
     def ensure_vertex_evaluated(self, vertex):
         """Ensure a vertex is evaluated and added to the graph"""
         if isinstance(vertex, GraphVertex):
-            self.get_value(vertex)  # This will evaluate the vertex if needed
+            self.warm([vertex])
+
+    def warm(self, vertices, parallel=None, progress=None):
+        """
+        Evaluate vertices, their known descendants and everything those depend on exactly once, in topological waves.
+        With parallel=N the vertices of a wave are evaluated by N threads against the active state, with the single-flight
+        evaluations of enable_concurrency for the duration of the warm.
+        progress is called with (wave index, number of vertices in the wave, elapsed seconds) after each wave.
+        Returns the elapsed seconds of each wave.
+        """
+        if self.is_calculating():
+            raise RuntimeError('Cannot warm the graph while it is updating its state')
+
+        timings = []
+        executor = ThreadPoolExecutor(max_workers=parallel) if parallel and parallel > 1 else None
+        single_flight = None
+        if executor is not None and self._concurrency is None:
+            # Wave members may share parents no edge was discovered for yet, which must still be evaluated only once
+            single_flight = self._concurrency = _Concurrency(64)
+        try:
+            stack = self._state_stack
+            for index, wave in enumerate(self._waves(vertices)):
+                start_time = time.time()
+                if executor is None or len(wave) == 1:
+                    for vertex in wave:
+                        self.get_value(vertex)
+                else:
+                    futures = [executor.submit(self._get_value_on, stack, vertex) for vertex in wave]
+                    for future in futures:
+                        future.result()
+                elapsed = time.time() - start_time
+                timings.append(elapsed)
+                if progress is not None:
+                    progress(index, len(wave), elapsed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if single_flight is not None and self._concurrency is single_flight:
+                self._concurrency = None
+        return timings
+
+    def _waves(self, vertices):
+        # Known descendants of the vertices, and everything upstream of those, layered so that parents come in earlier waves
+        members = set(vertices)
+        for vertex in vertices:
+            members.update(self._downstream(vertex))
+        to_visit = list(members)
+        while to_visit:
+            for parent in to_visit.pop().parents:
+                if parent not in members:
+                    members.add(parent)
+                    to_visit.append(parent)
+        return _topological_layers(members)
+
+    def _get_value_on(self, state_stack, vertex):
+        # Evaluate from a worker thread against another thread's state stack
+        thread = current_thread()
+        saved_stack = self._state_stacks.get(thread)
+        self._state_stacks[thread] = state_stack
+        try:
+            return self.get_value(vertex)
+        finally:
+            if saved_stack is None:
+                del self._state_stacks[thread]
+            else:
+                self._state_stacks[thread] = saved_stack
+
+def _topological_closure(vertex, attr):
+    """Return the vertices reachable from vertex through attr ('children' or 'parents') in topological order"""
+    order = []
+    visited = {vertex}
+    stack = [(vertex, iter(getattr(vertex, attr)))]
+    while stack:
+        node, edges = stack[-1]
+        for other in edges:
+            if other not in visited:
+                visited.add(other)
+                stack.append((other, iter(getattr(other, attr))))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    # The post-order ends with vertex itself
+    order.pop()
+    order.reverse()
+    return tuple(order)
+
+def _topological_layers(vertices):
+    """Split vertices into layers such that the parents of a vertex among vertices all lie in earlier layers"""
+    in_degrees = {vertex: sum(1 for parent in vertex.parents if parent in vertices) for vertex in vertices}
+    layer = [vertex for vertex, in_degree in in_degrees.items() if not in_degree]
+    layers = []
+    while layer:
+        layers.append(layer)
+        next_layer = []
+        for vertex in layer:
+            del in_degrees[vertex]
             for child in vertex.children:
-                self.ensure_vertex_evaluated(child)
+                if child in in_degrees:
+                    in_degrees[child] -= 1
+                    if not in_degrees[child]:
+                        next_layer.append(child)
+        layer = next_layer
+    if in_degrees:
+        # Vertices on a cycle never become ready and end up in a last layer
+        layers.append(list(in_degrees))
+    return layers
+
+def _has_invalid_parent(vertex, source, graph_state):
+    for parent in vertex.parents:
+        if parent is source:
+            return True
+        payload = graph_state.get(parent)
+        if payload is not None and not payload._flags & VertexPayload.VALID:
+            return True
+    return False
+
+def _vertices_by_stable_id(objects):
+    # Ids shared by several vertices are ambiguous and left out
+    vertices = {}
+    ambiguous = set()
+    for obj in objects:
+        for member in vars(obj).values():
+            if isinstance(member, GraphVertex) and member._obj is obj:
+                stable_id = member.stable_id
+                if vertices.setdefault(stable_id, member) is not member:
+                    ambiguous.add(stable_id)
+    for stable_id in ambiguous:
+        del vertices[stable_id]
+    return vertices
+
+_SNAPSHOT_MAGIC = b'EGS1'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<4sIQ')
+
+class _EvaluationBudget(object):
+    """The deadline and cancellation tokens an evaluation checks before each vertex it evaluates"""
+
+    def __init__(self, deadline, token):
+        self.deadline = deadline
+        self.tokens = (token,) if token is not None else ()
+        self.started = time.monotonic()
+        self.evaluated = 0
+
+    def check(self, vertex):
+        now = time.monotonic()
+        if any(token.cancelled for token in self.tokens):
+            reason = 'cancelled'
+        elif self.deadline is not None and now >= self.deadline:
+            reason = 'deadline'
+        else:
+            return
+        stats = {
+            'reason': reason,
+            'evaluated': self.evaluated,
+            'elapsed': now - self.started,
+            'vertex': vertex,
+        }
+        raise EvaluationAborted("Evaluation of {} aborted ({}) after {} vertices".format(vertex, reason, self.evaluated), stats)
+
+_INVALID = object()
+
+class _Flight(object):
+    """An evaluation in progress on some thread, which other threads asking for the same payload wait for"""
+
+    def __init__(self, budget=None):
+        self.owner = current_thread()
+        self.budget = budget
+        # Set by a write reaching the payload during the evaluation, whose result is then not kept
+        self.stale = False
+        self.value = None
+        self.error = None
+        self.done = Event()
+
+class _Concurrency(object):
+    """
+    The locks of a graph shared by several threads. Payload flags are only changed under the write lock, while the
+    striped locks guard the short registration of in-flight evaluations.
+    """
+
+    def __init__(self, stripes):
+        self.write_lock = RLock()
+        self._stripes = [Lock() for _ in range(stripes)]
+        self._flights = {}
+
+    def _stripe(self, payload):
+        return self._stripes[(id(payload) >> 4) % len(self._stripes)]
+
+    def writing(self):
+        return self.write_lock
+
+    def evaluating(self):
+        """Return whether any payload is being evaluated"""
+        return bool(self._flights)
+
+    def mark_stale(self, payload):
+        """Keep the evaluation of payload in progress, if any, from caching its result, called under the write lock"""
+        flight = self._flights.get(payload)
+        if flight is not None:
+            flight.stale = True
+
+    def add_edge(self, vertex, child):
+        with self.write_lock:
+            if child not in vertex.children:
+                child.parents.add(vertex)
+                vertex.children.add(child)
+                vertex._graph._edges_changed()
+
+    def read(self, payload):
+        """Return the value of a valid payload without locking, or _INVALID"""
+        # The value is read on both sides of the flags: invalidate clears the flags before the value and an evaluation
+        # sets the value before the flags, so an unchanged value around valid flags is consistent
+        value = payload._value
+        if payload._flags & (VertexPayload.VALID | VertexPayload.DEFERRED) != VertexPayload.VALID:
+            if payload._flags & VertexPayload.DEFERRED:
+                with self.write_lock:
+                    return payload.value if payload.is_valid() else _INVALID
+            return _INVALID
+        if payload._value is not value:
+            return _INVALID
+        return value
+
+    def acquire(self, payload, budget):
+        """
+        Return a flight owned by the calling thread if it should evaluate payload itself, otherwise a landed flight holding
+        the value another thread evaluated. An error of that thread is raised again, unless it may not apply to the calling
+        thread: an abort, or any error of an evaluation running under another budget, makes the calling thread evaluate it.
+        """
+        while True:
+            flight = self.join(payload, budget)
+            if flight.owner is current_thread():
+                return flight
+            flight.done.wait()
+            if flight.error is None:
+                return flight
+            if not isinstance(flight.error, EvaluationAborted) and flight.budget is budget:
+                raise flight.error
+
+    def join(self, payload, budget=None):
+        """Return the flight evaluating payload, owned by the calling thread if it should evaluate it itself"""
+        with self._stripe(payload):
+            flight = self._flights.get(payload)
+            if flight is None:
+                value = self.read(payload)
+                if value is not _INVALID:
+                    # Another thread committed the payload since it was read
+                    flight = _Flight()
+                    flight.owner = None
+                    flight.value = value
+                    flight.done.set()
+                else:
+                    flight = self._flights[payload] = _Flight(budget)
+                return flight
+        if flight.owner is current_thread():
+            raise RuntimeError('Cycle detected while evaluating {}'.format(payload.vertex))
+        return flight
+
+    def commit(self, payload, flight, value, spill=None):
+        with self.write_lock:
+            # A write reaching the payload during the evaluation may have changed a parent it already read
+            if not flight.stale:
+                payload.value = value
+                if spill is not None:
+                    spill.track(payload)
+        self._land(payload, flight)
+        flight.value = value
+        flight.done.set()
+
+    def fail(self, payload, flight, error):
+        # Errors are handed to the waiting threads but never cached, acquire decides whether they apply to each of them
+        self._land(payload, flight)
+        flight.error = error
+        flight.done.set()
+
+    def _land(self, payload, flight):
+        with self._stripe(payload):
+            if self._flights.get(payload) is flight:
+                del self._flights[payload]
+
+class _MappedValue(object):
+    """A pickled value inside a memory-mapped snapshot, only unpickled when its payload is first read"""
+    __slots__ = ('_buffer', '_offset', '_length')
+
+    def __init__(self, buffer, offset, length):
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+
+    def load(self, payload):
+        return pickle.loads(self._buffer[self._offset:self._offset + self._length])
+
+class _ValueSpill(object):
+    """
+    Tracks the resident large values of a graph and spills the least recently used ones to an append-only file. Its
+    bookkeeping and file are guarded by its own lock, and in concurrent mode values are tracked and loaded under the
+    write lock as well, which guards the flags of the payloads spilling changes.
+    """
+
+    def __init__(self, threshold, budget, directory=None):
+        self._threshold = threshold
+        self._budget = budget
+        self._lock = RLock()
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._size = 0
+        self._buffer = None
+        # weakref(payload) -> (id(value), size, handle the value was loaded from), least recently used first
+        self._resident = OrderedDict()
+        self._resident_bytes = 0
+        self._spilled = 0
+        self._spilled_bytes = 0
+        self._loaded = 0
+
+    @property
+    def stats(self):
+        return {
+            'resident_bytes': self._resident_bytes,
+            'resident_values': len(self._resident),
+            'spilled': self._spilled,
+            'spilled_bytes': self._spilled_bytes,
+            'loaded': self._loaded,
+        }
+
+    def track(self, payload):
+        value = payload._value
+        size = _estimate_size(value)
+        if size < self._threshold:
+            return
+        with self._lock:
+            self._account(payload, value, size, None)
+            self._enforce_budget()
+
+    def _enforce_budget(self):
+        # The value tracked last is the most recently used one and is never spilled right away
+        while self._resident_bytes > self._budget and len(self._resident) > 1:
+            self._spill(*self._resident.popitem(last=False))
+
+    def _account(self, payload, value, size, handle):
+        key = weakref.ref(payload, self._forget)
+        previous = self._resident.pop(key, None)
+        if previous is not None:
+            self._resident_bytes -= previous[1]
+        self._resident[key] = (id(value), size, handle)
+        self._resident_bytes += size
+
+    def _forget(self, key):
+        with self._lock:
+            entry = self._resident.pop(key, None)
+            if entry is not None:
+                self._resident_bytes -= entry[1]
+
+    def _spill(self, key, entry):
+        value_id, size, handle = entry
+        self._resident_bytes -= size
+        payload = key()
+        # Payloads invalidated or recomputed since they were tracked no longer hold the tracked value
+        if payload is None or payload._flags & VertexPayload.DEFERRED or id(payload._value) != value_id:
+            return
+        if handle is not None:
+            # The value was read back from the file and is still there
+            payload._value = handle
+            payload._flags |= VertexPayload.DEFERRED
+            return
+        try:
+            data = pickle.dumps(payload._value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        offset = self._size
+        self._file.seek(offset)
+        self._file.write(data)
+        self._size += len(data)
+        payload._value = _SpilledValue(self, offset, len(data), size)
+        payload._flags |= VertexPayload.DEFERRED
+        self._spilled += 1
+        self._spilled_bytes += len(data)
+
+    def load(self, payload, handle):
+        offset, length = handle._offset, handle._length
+        with self._lock:
+            if self._buffer is None or len(self._buffer) < offset + length:
+                self._file.flush()
+                self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            value = pickle.loads(self._buffer[offset:offset + length])
+            self._account(payload, value, handle._size, handle)
+            self._loaded += 1
+            self._enforce_budget()
+        return value
+
+class _SpilledValue(object):
+    """A value spilled by _ValueSpill, read back from its memory-mapped file when its payload is next read"""
+    __slots__ = ('_spill', '_offset', '_length', '_size')
+
+    def __init__(self, spill, offset, length, size):
+        self._spill = spill
+        self._offset = offset
+        self._length = length
+        self._size = size
+
+    def load(self, payload):
+        return self._spill.load(payload, self)
 
 _graph = Graph()
 
@@ -280,6 +1482,8 @@ class VertexPayload(object):
     NONE = 0x0000
     VALID = 0x0001
     FIXED = 0x0002
+    # The value is held by a handle whose load(payload) method returns the actual value
+    DEFERRED = 0x0004
 
     def __init__(self, vertex, graph_state, flags=NONE, value=None):
         self._vertex = vertex
@@ -303,19 +1507,22 @@ class VertexPayload(object):
     def value(self):
         if not self.is_valid() and not self.is_fixed():
             raise RuntimeError("This node's value needs to be computed or set")
+        if self._flags & VertexPayload.DEFERRED:
+            self._value = self._value.load(self)
+            self._flags &= ~VertexPayload.DEFERRED
         return self._value
     
     @value.setter
     def value(self, value):
         self._value = value
-        self._flags |= VertexPayload.VALID
+        self._flags = (self._flags | VertexPayload.VALID) & ~VertexPayload.DEFERRED
     
     def fix_value(self, value):
         self.value = value
         self._flags |= VertexPayload.FIXED
 
     def invalidate(self):
-        self._flags &= ~VertexPayload.VALID
+        self._flags &= ~(VertexPayload.VALID | VertexPayload.DEFERRED)
         self._value = None
 
     def is_valid(self):
@@ -338,9 +1545,11 @@ class GraphVertex(object):
     As part of an acyclic directed graph, edges which connect vertices are directed in a parent -> child fashion such that the payload of the child is dependent upon the payload of the parent.
     """
 
-    def __init__(self, obj, func) -> None:
+    def __init__(self, obj, func, store=None, pure=False) -> None:
         self._obj = obj
         self._func = func
+        self._store = store
+        self._pure = pure
         self._id = "{}.{}".format(self._obj.__class__.__name__, self._func.__name__)
         self.parents = set()
         self.children = set()
@@ -365,13 +1574,19 @@ class GraphVertex(object):
     def __str__(self) -> str:
         return self._id
 
+    @property
+    def stable_id(self):
+        """The vertex id qualified by the graph_key of its GraphObject, stable across processes"""
+        key = getattr(self._obj, 'graph_key', None)
+        return self._id if key is None else "{}[{}]".format(self._id, key)
+
     __repr__ = __str__
 
     def __call__(self, *args, **kwargs):
         # This hack allows us to manipulate the stacktrace, effectively removing the graph inner-working from it
         # Note that if an error would stem from the graph, the stacktrace would still be intact
         try:
-            value = self._graph.get_value(self)
+            value = self._graph.get_value(self, **kwargs)
         except:
             ex_type, ex, ex_tb = sys.exc_info()
             hacked_tb = ex_tb
@@ -418,15 +1633,33 @@ class GraphVertex(object):
         if self._graph.is_debug_mode:
             print("{}.clear_diddle() -> {}".format(self._id, CLEAR))
 
+    def subscribe(self, callback):
+        self._graph.subscribe(self, callback)
+
+    def unsubscribe(self, callback):
+        self._graph.unsubscribe(self, callback)
+
 class Vertex(object):
     """
     The decorator used to indicator
+    Options are given through the @Vertex(...) form:
+    : param store: ResultStore consulted before evaluating the vertex, whose value must be a pure function of its parents' values
+    : param pure: the value only depends on the parents' values, so it can be shared across instances, see Graph.enable_sharing
     """
 
-    def __init__(self, func) -> None:
+    def __init__(self, func=None, store=None, pure=False) -> None:
+        self.func = func
+        self.store = store
+        self.pure = pure
+
+    def __call__(self, func):
         self.func = func
+        return self
 
 class GraphObject(object):
+    # Identifies the instance among the other instances of its class across processes, see GraphVertex.stable_id
+    graph_key = None
+
     def __new__(cls, *args, **kwargs):
         """
         We control here the creation of the GraphObject. All the magic here happens as follows.
@@ -438,7 +1671,8 @@ class GraphObject(object):
         for member_name in dir(cls):
             member = getattr(cls, member_name, None)
             if isinstance(member, Vertex):
-                setattr(instance, member_name, GraphVertex(instance, member.func))
+                setattr(instance, member_name, GraphVertex(instance, member.func, store=member.store, pure=member.pure))
+        _graph._objects.add(instance)
         return instance
 
 class DiddleScope(GraphState):
@@ -454,39 +1688,76 @@ class DiddleScope(GraphState):
         self._saved_debug_mode = None
 
     def __enter__(self):
+        self._graph._diddle_enters += 1
         self._parent_state = self._graph.push_state(self)
         self._parent_state.copy(self)
+        self._written = set()
         self._saved_debug_mode = self._parent_state._graph._debug_mode
         self._parent_state._graph._debug_mode = self._debug_mode
 
     def __exit__(self, extype, exvalue, tb):
         self._parent_state._graph._debug_mode = self._saved_debug_mode
         self._graph.pop_state()
+        notified, self._notified_values = self._notified_values, {}
         self.clear()
+        self._written = None
         self._parent_state = None
+        if notified:
+            self._graph._notify_reverted(notified)
         return extype is None
 
 class SetScope(object):
+    """
+    A SetScope object is used in conjunction with a "with" block to fix the values of vertices until the block exits.
+    The payloads it replaces are kept in an undo journal rather than read, so entering evaluates nothing, and exiting puts
+    them back with a single batch of invalidations. Replaced derived values are recomputed on demand, as after clear_value.
+    """
+
     def __init__(self, overrides):
         self._overrides = overrides
-        self._to_revert = {}
-        self._to_clear = set()
+        self._graph_state = None
+        self._journal = None
 
     def __enter__(self):
-        for vertex, override in self._overrides.items():
-            if vertex.is_fixed():
-                self._to_revert[vertex] = vertex()
-            else:
-                self._to_clear.add(vertex)
-            vertex.set_value(override)
+        if _graph.is_calculating():
+            raise RuntimeError('Graph cannot be modified while its updating its state')
+
+        graph_state = self._graph_state = _graph.active_state
+        journal = self._journal = {}
+        with _graph._writing():
+            for vertex, override in self._overrides.items():
+                previous = graph_state.get(vertex)
+                if previous is None or not previous.is_fixed() or previous.value != override:
+                    journal[vertex] = previous
+                    payload = graph_state[vertex] = VertexPayload(vertex, graph_state, VertexPayload.FIXED | VertexPayload.VALID, override)
+                    if _graph._spill is not None:
+                        _graph._spill.track(payload)
+            self._invalidate()
+        self._notify()
 
     def __exit__(self, extype, exvalue, tb):
-        for vertex, prev_value in self._to_revert.items():
-            vertex.set_value(prev_value)
-        for vertex in self._to_clear:
-            vertex.clear_value()
+        graph_state = self._graph_state
+        with _graph._writing():
+            for vertex, previous in self._journal.items():
+                if previous is not None and previous.is_fixed():
+                    graph_state[vertex] = previous
+                else:
+                    graph_state.pop(vertex, None)
+            self._invalidate()
+        self._notify()
+        self._graph_state = None
+        self._journal = None
         return extype is None
 
+    def _invalidate(self):
+        for vertex in self._journal:
+            _graph._invalidate_children(vertex)
+
+    def _notify(self):
+        with _graph.batch():
+            for vertex in self._journal:
+                _graph._after_write(vertex)
+
 
 def is_fixed(vertex):
     if not isinstance(vertex, GraphVertex):
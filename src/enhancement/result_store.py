@@ -0,0 +1,275 @@
+import hashlib
+import io
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+_MISSING = object()
+
+def _pickle(value: Any) -> bytes:
+    # Without memoization, equal objects pickle the same whether or not they are the same object
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=4)
+    pickler.fast = True
+    try:
+        pickler.dump(value)
+    except ValueError as e:
+        raise pickle.PicklingError(str(e)) from e
+    return buffer.getvalue()
+
+def _encode(value: Any, write: Callable[[bytes], Any], active: set) -> None:
+    cls = type(value)
+    if value is None or cls is bool:
+        write(b'N' if value is None else b'T' if value else b'F')
+    elif cls is int:
+        data = str(value).encode()
+        write(b'i' + struct.pack('>Q', len(data)) + data)
+    elif cls is float:
+        write(b'f' + struct.pack('>d', value))
+    elif cls is str or cls is bytes:
+        data = value.encode('utf-8', 'surrogatepass') if cls is str else value
+        write((b's' if cls is str else b'b') + struct.pack('>Q', len(data)) + data)
+    elif cls in (tuple, list, set, frozenset, dict):
+        if id(value) in active:
+            raise TypeError('Cannot hash a self-referencing {}'.format(cls.__name__))
+        active.add(id(value))
+        try:
+            if cls is dict:
+                items = [_encoded(item, active) for item in value.items()]
+            else:
+                items = [_encoded(item, active) for item in value]
+            if cls is not tuple and cls is not list:
+                # Sets and dicts compare regardless of their order, which depends on the process's hash seed
+                items.sort()
+            write({tuple: b't', list: b'l', set: b'S', frozenset: b'Z', dict: b'd'}[cls] + struct.pack('>Q', len(items)))
+            for item in items:
+                write(item)
+        finally:
+            active.discard(id(value))
+    else:
+        data = _pickle(value)
+        write(b'p' + struct.pack('>Q', len(data)) + data)
+
+def _encoded(value: Any, active: set) -> bytes:
+    parts = []
+    _encode(value, parts.append, active)
+    return b''.join(parts)
+
+def stable_hash(value: Any) -> str:
+    """
+    Hashes a value into a hex digest that is stable across processes. Built-in scalars and containers are encoded
+    canonically, with the items of sets and dicts sorted, and other values are pickled.
+
+    Args:
+        value: The value to hash.
+
+    Returns:
+        The hex digest of the encoded value.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    _encode(value, digest.update, set())
+    return digest.hexdigest()
+
+class ResultStore(object):
+    """
+    A content-addressed store of pickled results kept in a sqlite file, which can be shared by several processes.
+    Once the stored values exceed max_bytes, the least recently used entries are evicted.
+
+    Example:
+    >>> store = ResultStore('/tmp/results.sqlite', max_bytes=2 ** 30)
+    >>> store.put(stable_hash(('calibrate', 'usd')), curve)
+    >>> store.get(stable_hash(('calibrate', 'usd')))
+    >>> store.stats
+    Output:
+        {'hits': 1, 'misses': 0, 'evictions': 0, 'entries': 1, 'bytes': 1234}
+    """
+
+    def __init__(self, path: str, max_bytes: Optional[int] = None) -> None:
+        self._path = str(path)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        # Connected on first use, by each process using the store
+        self._pid = None
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection must not be used across a fork, so a forked worker opens its own on first use
+        if self._pid == os.getpid():
+            return self._connection
+        self._connection = connection = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._pid = os.getpid()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            # The total size is kept up to date by triggers, so that checking it on every put is constant time
+            connection.execute('CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)')
+            connection.execute('INSERT OR IGNORE INTO totals (id, size) SELECT 0, COALESCE(SUM(size), 0) FROM results')
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS results_inserted AFTER INSERT ON results '
+                'BEGIN UPDATE totals SET size = size + NEW.size WHERE id = 0; END'
+            )
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS results_resized AFTER UPDATE OF size ON results '
+                'BEGIN UPDATE totals SET size = size + NEW.size - OLD.size WHERE id = 0; END'
+            )
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS results_deleted AFTER DELETE ON results '
+                'BEGIN UPDATE totals SET size = size - OLD.size WHERE id = 0; END'
+            )
+            # The tags of each entry, which leave with it however it is removed
+            connection.execute('CREATE TABLE IF NOT EXISTS tags (tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key))')
+            connection.execute('CREATE INDEX IF NOT EXISTS tags_key ON tags (key)')
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS results_untagged AFTER DELETE ON results '
+                'BEGIN DELETE FROM tags WHERE key = OLD.key; END'
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return connection
+
+    @property
+    def path(self) -> str:
+        """Returns the path of the sqlite file."""
+        return self._path
+
+    @property
+    def max_bytes(self) -> Optional[int]:
+        """Returns the size above which entries get evicted."""
+        return self._max_bytes
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the value stored under key, or default, counting a hit or a miss.
+        """
+        value = self.peek(key, _MISSING)
+        with self._lock:
+            if value is _MISSING:
+                self._misses += 1
+                return default
+            self._hits += 1
+        return value
+
+    def peek(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the value stored under key, or default, without counting it in the stats.
+        """
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            connection.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put(self, key: str, value: Any, tags: Iterable[str] = ()) -> None:
+        """
+        Stores value under key with the given tags, replacing its previous tags, then evicts the least recently used
+        entries if the store went over max_bytes.
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # An upsert rather than INSERT OR REPLACE, whose implicit delete would not fire the delete triggers
+                connection.execute(
+                    'INSERT INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, accessed = excluded.accessed',
+                    (key, data, len(data), time.time())
+                )
+                connection.execute('DELETE FROM tags WHERE key = ?', (key,))
+                connection.executemany('INSERT OR IGNORE INTO tags (tag, key) VALUES (?, ?)', [(tag, key) for tag in tags])
+                if self._max_bytes is not None:
+                    self._evict(connection, self._max_bytes)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def delete(self, key: str) -> bool:
+        """
+        Removes the entry stored under key, returning whether there was one.
+        """
+        with self._lock:
+            return self._connect().execute('DELETE FROM results WHERE key = ?', (key,)).rowcount > 0
+
+    def delete_tagged(self, tag: str) -> List[str]:
+        """
+        Removes the entries carrying tag, returning their keys.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                keys = [row[0] for row in connection.execute('SELECT key FROM tags WHERE tag = ?', (tag,))]
+                connection.executemany('DELETE FROM results WHERE key = ?', [(key,) for key in keys])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return keys
+
+    def _evict(self, connection: sqlite3.Connection, max_bytes: int) -> None:
+        total = connection.execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+        if total <= max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM results ORDER BY accessed'):
+            if total <= max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+        self._evictions += len(evicted)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connect().execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit, miss and eviction counts of this instance along with the current entries and bytes stored."""
+        with self._lock:
+            connection = self._connect()
+            entries = connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            size = connection.execute('SELECT size FROM totals WHERE id = 0').fetchone()[0]
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': entries,
+                'bytes': size,
+            }
+
+    def clear(self) -> None:
+        """Removes every entry and resets the stats."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute('DELETE FROM results')
+            connection.execute('DELETE FROM tags')
+            self._hits = self._misses = self._evictions = 0
+
+    def close(self) -> None:
+        """Closes the underlying sqlite connection."""
+        with self._lock:
+            # A forked worker leaves the connection of its parent alone
+            if self._pid == os.getpid():
+                self._connection.close()
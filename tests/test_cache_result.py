@@ -1,4 +1,15 @@
-from src.enhancement.cache_result import cache_result
+import asyncio
+import gc
+import importlib
+import os
+import subprocess
+import sys
+import threading
+import time
+import weakref
+import pytest
+from src.enhancement.cache_result import Tagged, cache_batch, cache_result, register_hasher
+from src.enhancement.result_store import ResultStore
 
 # Test function counter to verify caching
 call_count = 0
@@ -70,7 +81,740 @@ def test_unhashable_args():
     global call_count
     call_count = 0
     
-    # Lists are unhashable, should fall back to direct execution
+    # Lists are unhashable, they are keyed by a fingerprint of their content
     assert function_with_unhashable([1, 2, 3]) == 6
     assert function_with_unhashable([1, 2, 3]) == 6
-    assert call_count == 2  # Should be called twice as caching is bypassed 
\ No newline at end of file
+    assert call_count == 1
+    assert function_with_unhashable([1, 2, 4]) == 7
+    assert function_with_unhashable((1, 2, 3)) == 6
+    assert call_count == 3
+
+@cache_result
+def returns_none(x):
+    """Function whose result is None."""
+    global call_count
+    call_count += 1
+
+def test_none_result_cached():
+    """Test that a None result is cached like any other."""
+    global call_count
+    call_count = 0
+
+    assert returns_none(1) is None
+    assert returns_none(1) is None
+    assert call_count == 1
+
+@cache_result
+def flexible_function(a, /, b=1, *args, c, d=2, **kwargs):
+    """Function with every kind of parameter."""
+    global call_count
+    call_count += 1
+    return (a, b, args, c, d, kwargs)
+
+def test_all_parameter_kinds():
+    """Test that equivalent calls share an entry whatever the parameter kinds."""
+    global call_count
+    call_count = 0
+
+    assert flexible_function(0, c=3) == (0, 1, (), 3, 2, {})
+    assert flexible_function(0, 1, c=3, d=2) == (0, 1, (), 3, 2, {})
+    assert call_count == 1
+
+    assert flexible_function(0, 1, 5, c=3, e=4, f=5) == (0, 1, (5,), 3, 2, {'e': 4, 'f': 5})
+    assert flexible_function(0, 1, 5, f=5, c=3, e=4) == (0, 1, (5,), 3, 2, {'e': 4, 'f': 5})
+    assert call_count == 2
+
+def test_invalid_arguments():
+    """Test that invalid arguments raise the function's own error."""
+    global call_count
+    call_count = 0
+
+    with pytest.raises(TypeError, match='expensive_function'):
+        expensive_function(1, 2, 3)
+    with pytest.raises(TypeError, match='flexible_function'):
+        flexible_function(0)
+    assert call_count == 0
+
+@cache_result
+def raises_type_error(x):
+    """Function raising a TypeError of its own."""
+    global call_count
+    call_count += 1
+    raise TypeError('bad x')
+
+def test_function_type_error_called_once():
+    """Test that a TypeError raised by the function is not mistaken for unhashable arguments."""
+    global call_count
+    call_count = 0
+
+    with pytest.raises(TypeError, match='bad x'):
+        raises_type_error(1)
+    assert call_count == 1
+
+def test_lru_maxsize():
+    """Test that the least recently used result is evicted."""
+    calls = []
+
+    @cache_result(maxsize=2)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    square(1)
+    square(2)
+    square(1)
+    square(3)  # Evicts 2, the least recently used
+    assert len(square._results_cache) == 2
+    square(1)
+    square(2)
+    assert calls == [1, 2, 3, 2]
+
+def test_lfu_maxsize():
+    """Test that the least frequently used result is evicted."""
+    calls = []
+
+    @cache_result(maxsize=2, policy='lfu')
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    square(1)
+    square(1)
+    square(2)
+    square(3)  # Evicts 2, used once while 1 was used twice
+    square(1)
+    square(2)
+    assert calls == [1, 2, 3, 2]
+
+def test_ttl(monkeypatch):
+    """Test that results expire after ttl seconds."""
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    calls = []
+
+    @cache_result(ttl=10)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    square(1)
+    now[0] = 5.0
+    square(1)
+    square(2)
+    now[0] = 11.0
+    square(1)
+    assert calls == [1, 2, 1]
+    # Expired entries are purged as new results get stored
+    assert len(square._results_cache) == 2
+
+def test_max_bytes():
+    """Test that results are evicted once their estimated size exceeds max_bytes."""
+    calls = []
+
+    @cache_result(max_bytes=30_000)
+    def payload(n):
+        calls.append(n)
+        return bytes(n)
+
+    payload(10_000)
+    payload(10_000)
+    payload(15_000)
+    payload(20_000)  # Evicts 10000
+    assert payload._results_cache.bytes <= 30_000
+    payload(10_000)
+    payload(100_000)  # Larger than the budget, never cached
+    payload(100_000)
+    assert calls == [10_000, 15_000, 20_000, 10_000, 100_000, 100_000]
+
+def test_unknown_policy():
+    """Test that an unknown policy is rejected at decoration time."""
+    with pytest.raises(ValueError):
+        cache_result(policy='fifo')
+
+def _call_in_threads(func, args):
+    """Calls func with each of args in its own thread and returns the results or errors."""
+    results = [None] * len(args)
+    def run(index):
+        try:
+            results[index] = func(args[index])
+        except Exception as ex:
+            results[index] = ex
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(args))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+def test_thread_safe_single_flight():
+    """Test that concurrent callers of the same key share a single call."""
+    calls = []
+    release = threading.Event()
+
+    @cache_result(thread_safe=True)
+    def quote(ticker):
+        calls.append(ticker)
+        release.wait(5)
+        return len(ticker)
+
+    threading.Timer(0.05, release.set).start()
+    assert _call_in_threads(quote, ['IBM'] * 8) == [3] * 8
+    assert calls == ['IBM']
+
+def test_thread_safe_errors_not_cached():
+    """Test that an error reaches every waiting caller and is not cached."""
+    calls = []
+    release = threading.Event()
+
+    @cache_result(thread_safe=True, maxsize=16)
+    def quote(ticker):
+        calls.append(ticker)
+        release.wait(5)
+        raise KeyError(ticker)
+
+    threading.Timer(0.05, release.set).start()
+    results = _call_in_threads(quote, ['IBM'] * 4)
+    assert all(isinstance(result, KeyError) for result in results)
+    assert calls == ['IBM']
+    with pytest.raises(KeyError):
+        quote('IBM')
+    assert calls == ['IBM', 'IBM']
+
+def test_thread_safe_keys_do_not_block_each_other():
+    """Test that callers of different keys run concurrently."""
+    started = {'IBM': threading.Event(), 'MSFT': threading.Event()}
+
+    @cache_result(thread_safe=True)
+    def quote(ticker):
+        started[ticker].set()
+        # Only returns if the other key is being computed at the same time
+        other = 'MSFT' if ticker == 'IBM' else 'IBM'
+        return started[other].wait(5)
+
+    assert _call_in_threads(quote, ['IBM', 'MSFT']) == [True, True]
+
+def test_coroutine_result_cached():
+    """Test that coroutine functions cache the awaited result."""
+    calls = []
+
+    @cache_result
+    async def fetch(name):
+        calls.append(name)
+        await asyncio.sleep(0)
+        return name.upper()
+
+    async def main():
+        return [await fetch('usd'), await fetch('usd'), await fetch(name='usd')]
+
+    assert asyncio.run(main()) == ['USD', 'USD', 'USD']
+    assert calls == ['usd']
+    assert asyncio.iscoroutinefunction(fetch)
+
+def test_coroutine_in_flight_shared():
+    """Test that concurrent awaiters share one call and that errors are shared but not cached."""
+    calls = []
+
+    @cache_result(maxsize=8)
+    async def fetch(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        if name == 'bad':
+            raise LookupError(name)
+        return name.upper()
+
+    async def main():
+        results = await asyncio.gather(*(fetch('usd') for _ in range(5)))
+        errors = await asyncio.gather(*(fetch('bad') for _ in range(3)), return_exceptions=True)
+        return results, errors
+
+    results, errors = asyncio.run(main())
+    assert results == ['USD'] * 5
+    assert all(isinstance(error, LookupError) for error in errors)
+    assert calls == ['usd', 'bad']
+    with pytest.raises(LookupError):
+        asyncio.run(fetch('bad'))
+    assert calls == ['usd', 'bad', 'bad']
+
+def test_coroutine_cancelled_awaiter():
+    """Test that cancelling one awaiter does not cancel the call shared with the others."""
+    calls = []
+
+    @cache_result
+    async def fetch(name):
+        calls.append(name)
+        await asyncio.sleep(0.02)
+        return name.upper()
+
+    async def main():
+        first = asyncio.ensure_future(fetch('usd'))
+        second = asyncio.ensure_future(fetch('usd'))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 'USD'
+    assert calls == ['usd']
+
+def _pricer(calls, factor):
+    """Returns a new function standing for the same pricer in another process, with its code scaled by factor."""
+    if factor == 2:
+        def price(x):
+            calls.append(x)
+            return x * 2
+    else:
+        def price(x):
+            calls.append(x)
+            return x * 3
+    price.__qualname__ = 'price'
+    return price
+
+def test_persistent_store(tmp_path):
+    """Test that results stored by one cache are read by a new one for the same code."""
+    path = tmp_path / 'results.sqlite'
+    calls = []
+
+    first = cache_result(store=path)(_pricer(calls, 2))
+    assert first(1) == 2
+    assert first(1) == 2
+    assert calls == [1]
+
+    # A cold cache, as in a new worker, reads the stored result
+    second = cache_result(store=ResultStore(path))(_pricer(calls, 2))
+    assert second(1) == 2
+    assert calls == [1]
+
+    # Changing the code of the function invalidates its stored results
+    changed = cache_result(store=str(path))(_pricer(calls, 3))
+    assert changed(1) == 3
+    assert calls == [1, 1]
+
+def test_persistent_store_version(tmp_path):
+    """Test that an explicit version replaces the hash of the code."""
+    store = ResultStore(str(tmp_path / 'results.sqlite'))
+    calls = []
+
+    assert cache_result(store=store, version='1')(_pricer(calls, 2))(1) == 2
+    assert cache_result(store=store, version='1')(_pricer(calls, 3))(1) == 2
+    assert cache_result(store=store, version='2')(_pricer(calls, 3))(1) == 3
+    assert calls == [1, 1]
+
+def test_persistent_store_expiry(tmp_path):
+    """Test that stored results expire with the ttl of the cache."""
+    path = tmp_path / 'results.sqlite'
+    calls = []
+
+    cached = cache_result(ttl=0.1, store=path)(_pricer(calls, 2))
+    assert cached(1) == 2
+    # A cold cache, as in a new worker, reads the stored result while it is fresh
+    assert cache_result(ttl=0.1, store=path)(_pricer(calls, 2))(1) == 2
+    assert calls == [1]
+
+    time.sleep(0.2)
+    assert cached(1) == 2
+    assert calls == [1, 1]
+    cached.reset_cache()
+    assert cached(1) == 2
+    assert calls == [1, 1]
+
+def test_code_version_across_processes():
+    """Test that the version of a function with a set literal is the same under different hash seeds."""
+    code = (
+        'from enhancement.cache_result import _code_version\n'
+        'def quote(ccy):\n'
+        "    return ccy in {'usd', 'eur', 'gbp', 'jpy', 'chf'}\n"
+        'print(_code_version(quote))'
+    )
+    versions = set()
+    for seed in ('1', '2', '3', '4'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        versions.add(subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout)
+    assert len(versions) == 1
+
+def test_fingerprinted_containers():
+    """Test that nested containers are keyed by their content."""
+    calls = []
+
+    @cache_result
+    def total(values, weights=None):
+        calls.append(values)
+        return sum(values['a']) + len(weights or ())
+
+    assert total({'a': [1, 2], 'b': {3}}) == 3
+    assert total({'b': {3}, 'a': [1, 2]}) == 3
+    assert len(calls) == 1
+
+    values = {'a': [1, 2]}
+    total(values, weights=[0.5])
+    values['a'].append(3)
+    assert total(values, weights=[0.5]) == 7
+    assert len(calls) == 3
+
+def test_fingerprinted_arrays():
+    """Test that arrays are keyed by their dtype, shape and bytes."""
+    np = pytest.importorskip('numpy')
+    calls = []
+
+    @cache_result
+    def norm(array):
+        calls.append(array)
+        return array.tolist()
+
+    array = np.arange(12.0).reshape(3, 4)
+    assert norm(array) == norm(array.copy())
+    assert len(calls) == 1
+    norm(array.reshape(4, 3))
+    norm(array.astype(np.float32))
+    norm(array[:, ::2])
+    norm(np.array([1, 'a'], dtype=object))
+    norm(np.array([1, 'a'], dtype=object))
+    assert len(calls) == 5
+    # datetime64 arrays expose no buffer, they are keyed through tolist
+    dates = np.array(['2026-10-19', '2026-10-20'], dtype='datetime64[D]')
+    assert norm(dates) == norm(dates.copy())
+    assert len(calls) == 6
+
+class Unhashable(object):
+    """A value type whose instances cannot be hashed."""
+    __hash__ = None
+
+    def __init__(self, value):
+        self.value = value
+
+def test_register_hasher():
+    """Test that registered hashers make custom unhashable types cacheable."""
+    calls = []
+
+    @cache_result
+    def read(item):
+        calls.append(item)
+        return item.value
+
+    read(Unhashable(1))
+    read(Unhashable(1))
+    assert len(calls) == 2
+
+    register_hasher(Unhashable, lambda item: [item.value])
+    read(Unhashable(1))
+    read(Unhashable(1))
+    read(Unhashable(2))
+    assert len(calls) == 4
+
+def test_self_referencing_argument():
+    """Test that self-referencing arguments are not cached rather than recursing forever."""
+    calls = []
+
+    @cache_result
+    def length(items):
+        calls.append(items)
+        return len(items)
+
+    items = [1]
+    items.append(items)
+    assert length(items) == 2
+    assert length(items) == 2
+    assert len(calls) == 2
+
+class Portfolio(object):
+    """Instances compare by value and are unhashable, like many domain objects."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+
+    def __eq__(self, other):
+        return isinstance(other, Portfolio) and self.name == other.name
+
+    @cache_result(per_instance=True, maxsize=8)
+    def value(self, scale=1):
+        self.calls += 1
+        return len(self.name) * scale
+
+    @cache_result(per_instance=True)
+    async def fetch(self, field):
+        self.calls += 1
+        return '{}.{}'.format(self.name, field)
+
+def test_per_instance_caches():
+    """Test that each instance gets its own cache, which can be reset on its own."""
+    first, second = Portfolio('rates'), Portfolio('rates')
+    assert first.value() == 5
+    assert first.value(scale=1) == 5
+    assert second.value() == 5
+    assert (first.calls, second.calls) == (1, 1)
+
+    first.value.reset_cache()
+    first.value()
+    second.value()
+    assert (first.calls, second.calls) == (2, 1)
+    assert Portfolio.value(second) == 5
+    assert second.calls == 1
+
+def test_per_instance_caches_do_not_pin_instances():
+    """Test that caching a method does not keep its instance alive, and that its cache goes with it."""
+    portfolio = Portfolio('credit')
+    assert portfolio.value(2) == 12
+    assert asyncio.run(portfolio.fetch('pv')) == 'credit.pv'
+    assert asyncio.run(portfolio.fetch('pv')) == 'credit.pv'
+    assert portfolio.calls == 2
+    caches = Portfolio.__dict__['value']._caches
+    assert id(portfolio) in caches
+
+    ref = weakref.ref(portfolio)
+    key = id(portfolio)
+    del portfolio
+    gc.collect()
+    assert ref() is None
+    assert key not in caches
+
+def test_per_instance_caches_share_key_builder(monkeypatch):
+    """Test that the signature of a per-instance method is analysed once, whatever the number of instances."""
+    module = importlib.import_module('src.enhancement.cache_result')
+    builds = []
+    key_builder = module._key_builder
+    monkeypatch.setattr(module, '_key_builder', lambda signature: builds.append(signature) or key_builder(signature))
+
+    class Book(object):
+        def __init__(self, size):
+            self.size = size
+
+        @cache_result(per_instance=True, thread_safe=True)
+        def notional(self, scale, shift=0):
+            return self.size * scale + shift
+
+    books = [Book(size) for size in range(3)]
+    assert [book.notional(2) for book in books] == [0, 2, 4]
+    assert [book.notional(scale=2, shift=1) for book in books] == [1, 3, 5]
+    assert len(builds) == 1
+    assert list(builds[0].parameters) == ['scale', 'shift']
+    assert Book.__dict__['notional']._stripes is not None
+
+def test_per_instance_cannot_be_stored(tmp_path):
+    """Test that per-instance caches refuse a persistent store."""
+    with pytest.raises(ValueError):
+        cache_result(per_instance=True, store=str(tmp_path / 'results.sqlite'))
+
+def test_cache_batch_only_computes_misses():
+    """Test that a batch call only passes the missing items to the function and returns results in order."""
+    batches = []
+
+    @cache_batch
+    def fetch_prices(ids, date='today'):
+        batches.append(list(ids))
+        return ['{}@{}'.format(i, date) for i in ids]
+
+    assert fetch_prices(['IBM', 'MSFT']) == ['IBM@today', 'MSFT@today']
+    assert fetch_prices(['MSFT', 'AAPL', 'IBM', 'AAPL']) == ['MSFT@today', 'AAPL@today', 'IBM@today', 'AAPL@today']
+    assert fetch_prices(['IBM'], date='today') == ['IBM@today']
+    assert fetch_prices(ids=['IBM'], date='eod') == ['IBM@eod']
+    assert batches == [['IBM', 'MSFT'], ['AAPL'], ['IBM']]
+
+    assert fetch_prices.invalidate(key=fetch_prices.cache_key('MSFT', date='today')) == 1
+    assert fetch_prices(['IBM', 'MSFT']) == ['IBM@today', 'MSFT@today']
+    assert batches[-1] == ['MSFT']
+
+    fetch_prices.reset_cache()
+    fetch_prices(['IBM'])
+    assert batches[-1] == ['IBM']
+
+def test_cache_batch_mapping_results():
+    """Test that the function may return a mapping of item to result, and unhashable items still get results."""
+    batches = []
+
+    @cache_batch(maxsize=2)
+    def lengths(items):
+        batches.append(list(items))
+        return {item: len(item) for item in items if isinstance(item, str)} or [len(item) for item in items]
+
+    assert lengths(['a', 'bb']) == [1, 2]
+    assert lengths(['bb', 'ccc']) == [2, 3]
+    assert batches == [['a', 'bb'], ['ccc']]
+    assert lengths([[1, 2]]) == [2]
+    assert lengths([[1, 2]]) == [2]
+    assert len(batches) == 3
+
+def test_cache_batch_result_count_mismatch():
+    """Test that returning the wrong number of results is reported."""
+    @cache_batch
+    def broken(ids):
+        return ids[:1]
+
+    with pytest.raises(ValueError, match='returned 1 results for 2 items'):
+        broken([1, 2])
+    with pytest.raises(ValueError):
+        cache_batch(lambda *ids: ids)
+
+def test_expire_on_session_close(monkeypatch):
+    """Test that results expire at the next close of the exchange."""
+    pytest.importorskip('exchange_calendars')
+    # Tuesday 2026-10-20 15:00 UTC, while NYSE is open until 20:00 UTC
+    now = [1792508400.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    calls = []
+
+    @cache_result(expire_on='XNYS:close')
+    def reference_data(name):
+        calls.append(name)
+        return name.upper()
+
+    reference_data('usd')
+    now[0] += 5 * 3600 - 1
+    reference_data('usd')
+    assert calls == ['usd']
+    now[0] += 1
+    reference_data('usd')
+    assert calls == ['usd', 'usd']
+
+    # Stored after the close, it lives until the close of the next session
+    now[0] += 3600
+    reference_data('eur')
+    now[0] += 12 * 3600
+    reference_data('eur')
+    assert calls == ['usd', 'usd', 'eur']
+
+def test_expire_on_invalid():
+    """Test that malformed expire_on specs are rejected at decoration time."""
+    with pytest.raises(ValueError):
+        cache_result(expire_on='XNYS')
+    with pytest.raises(ValueError):
+        cache_result(expire_on='XNYS:noon')
+
+def test_bounded_cache_from_threads():
+    """Test that a bounded cache can be called from several threads without thread_safe."""
+    @cache_result(maxsize=8, policy='lfu', ttl=0.001)
+    def square(x):
+        return x * x
+
+    errors = []
+
+    def run():
+        try:
+            for i in range(2000):
+                assert square(i % 16) == (i % 16) ** 2
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+def test_invalidate_by_tag():
+    """Test that invalidating a tag only removes the results carrying it."""
+    calls = []
+
+    @cache_result(tags=lambda currency, tenor: [currency])
+    def rate(currency, tenor):
+        calls.append((currency, tenor))
+        if tenor == '10y':
+            return Tagged(0.04, ['long end'])
+        return 0.05
+
+    for currency in ('usd', 'eur'):
+        for tenor in ('1y', '10y'):
+            rate(currency, tenor)
+    assert rate('usd', '10y') == 0.04
+    assert len(calls) == 4
+
+    assert rate.invalidate(tag='usd') == 2
+    rate('usd', '1y')
+    rate('eur', '1y')
+    assert len(calls) == 5
+
+    # The usd 10y result was recomputed with its tags, so both long end results go
+    rate('usd', '10y')
+    assert rate.invalidate(tag='long end') == 2
+    assert rate.invalidate(tag='long end') == 0
+    assert len(rate._results_cache) == 2
+
+def test_invalidate_stored_results(tmp_path):
+    """Test that invalidating removes results from the store, and that stored results keep their tags."""
+    path = tmp_path / 'results.sqlite'
+    calls = []
+
+    def load_curve(currency):
+        calls.append(currency)
+        return Tagged(len(calls), ['curves'])
+    load_curve.__qualname__ = 'load_curve'
+
+    cached = cache_result(store=path, tags=lambda currency: [currency])(load_curve)
+    assert cached('USD') == 1
+    assert cached.invalidate(tag='USD') == 1
+    assert cached('USD') == 2
+    assert calls == ['USD', 'USD']
+
+    # The tags returned in a Tagged are read back from the store along with the result
+    cached.reset_cache()
+    assert cached('USD') == 2
+    assert cached.invalidate(tag='curves') == 1
+    assert cached('USD') == 3
+
+    # A cold cache, as in a new worker, removes the results other caches stored
+    cached('EUR')
+    cold = cache_result(store=path, tags=lambda currency: [currency])(load_curve)
+    assert cold.invalidate(tag='curves') == 2
+    assert cached.invalidate(tag='curves') == 2
+    assert cold('EUR') == 5
+
+def test_invalidate_by_key():
+    """Test that invalidating a key only removes its result."""
+    calls = []
+
+    @cache_result
+    def weights(names, scale=1):
+        calls.append(names)
+        return Tagged([scale] * len(names), ['weights'])
+
+    assert weights(['a', 'b']) == [1, 1]
+    weights(['c'])
+    assert weights.invalidate(key=weights.cache_key(['a', 'b'], scale=1)) == 1
+    weights(['a', 'b'])
+    weights(['c'])
+    assert len(calls) == 3
+
+def test_invalidate_while_storing():
+    """Test that a thread-safe invalidate running while a result is stored waits for its tags to be indexed."""
+    @cache_result(thread_safe=True, tags=lambda x: ['curves'])
+    def curve(x):
+        return x
+
+    index = curve._tag_index
+    add = index.add
+    removed = []
+    invalidating = threading.Thread(target=lambda: removed.append(curve.invalidate(tag='curves')))
+
+    def add_after_invalidate(cache, key, tags):
+        # The invalidate starts from another thread after the result was stored, but before its tags are indexed
+        invalidating.start()
+        invalidating.join(0.1)
+        add(cache, key, tags)
+
+    index.add = add_after_invalidate
+    assert curve(1) == 1
+    invalidating.join()
+    assert removed == [1]
+    assert len(curve._results_cache) == 0
+
+def test_tag_index_cleaned_on_eviction():
+    """Test that evicted results leave the tag index."""
+    @cache_result(maxsize=2, tags=lambda x: ['even' if x % 2 == 0 else 'odd'])
+    def identity(x):
+        return x
+
+    for x in range(10):
+        identity(x)
+    assert len(identity._tag_index._tags) == 2
+    assert identity.invalidate(tag='even') == 1
+    assert identity.invalidate(tag='odd') == 1
+    assert len(identity._results_cache) == 0
+
+def test_tagged_result_bypassing_cache():
+    """Test that Tagged results are unwrapped even when the call bypasses the cache."""
+    @cache_result(thread_safe=True)
+    def first(items):
+        return Tagged(items[0], ['items'])
+
+    items = [1]
+    items.append(items)
+    assert first(items) == 1
@@ -86,4 +86,45 @@ def test_diddle_debug_mode():
         obj.value.set_diddle(10)
         assert obj.value() == 10
     
-    assert obj.value() == 42 
\ No newline at end of file
+    assert obj.value() == 42
+
+def test_diff_against_parent_state(basic_graph_object):
+    """Test comparing a diddle scope with the state it was entered from"""
+    from src.enhancement.graph import _graph
+
+    root = _graph.active_state
+    assert basic_graph_object.double_value() == 84
+    with DiddleScope():
+        scope = _graph.active_state
+        basic_graph_object.value.set_diddle(10)
+        assert basic_graph_object.triple_value() == 30
+
+        changed, added, removed = root.diff(scope)
+        assert changed == {basic_graph_object.value: (42, 10)}
+        assert added == {basic_graph_object.triple_value: 30}
+        assert removed == {basic_graph_object.double_value: 84}
+        assert scope._written == {basic_graph_object.value, basic_graph_object.double_value, basic_graph_object.triple_value}
+
+        changed, added, removed = scope.diff(root, vertices=[basic_graph_object.value])
+        assert changed == {basic_graph_object.value: (10, 42)}
+        assert added == {}
+        assert removed == {}
+
+def test_diff_between_nested_scopes(basic_graph_object):
+    """Test comparing nested scopes, and unrelated states"""
+    from src.enhancement.graph import GraphState, _graph
+
+    assert basic_graph_object.double_value() == 84
+    with DiddleScope():
+        outer = _graph.active_state
+        basic_graph_object.value.set_diddle(10)
+        with DiddleScope():
+            inner = _graph.active_state
+            assert basic_graph_object.double_value() == 20
+            assert outer.diff(inner) == ({}, {basic_graph_object.double_value: 20}, {})
+            assert inner.diff(inner) == ({}, {}, {})
+
+            unrelated = GraphState(_graph)
+            changed, added, removed = unrelated.diff(inner)
+            assert added[basic_graph_object.value] == 10
+            assert added[basic_graph_object.double_value] == 20
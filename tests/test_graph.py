@@ -1,7 +1,9 @@
+import threading
+import time
 import pytest
 from enhancement.graph import (
     Graph, GraphObject, Vertex, DiddleScope, SetScope,
-    is_fixed, _graph
+    CancellationToken, EvaluationAborted, is_fixed, _graph
 )
 
 # Test fixtures
@@ -198,4 +200,643 @@ def test_path_finding(simple_graph):
     simple_graph.c()  # Build dependencies
     paths = _graph.get_all_paths('SimpleGraph.a', 'SimpleGraph.c')
     assert len(paths) == 1
-    assert paths[0] == ['SimpleGraph.a', 'SimpleGraph.b', 'SimpleGraph.c'] 
\ No newline at end of file
+    assert paths[0] == ['SimpleGraph.a', 'SimpleGraph.b', 'SimpleGraph.c']
+
+# Test subscriptions
+def test_subscribe_notifies_changed_values(simple_graph):
+    notifications = []
+    simple_graph.c.subscribe(notifications.append)
+    try:
+        simple_graph.a.set_value(10)
+        assert notifications == [{simple_graph.c: 23}]
+
+        # Writing the same value again does not invalidate anything
+        simple_graph.a.set_value(10)
+        assert len(notifications) == 1
+    finally:
+        simple_graph.c.unsubscribe(notifications.append)
+
+    simple_graph.a.clear_value()
+    assert len(notifications) == 1
+
+def test_subscribe_after_diddle_scope(simple_graph):
+    notifications = []
+    simple_graph.c.subscribe(notifications.append)
+    try:
+        simple_graph.a.set_value(10)
+        with DiddleScope():
+            simple_graph.a.set_diddle(1)
+            assert notifications == [{simple_graph.c: 23}, {simple_graph.c: 5}]
+        # Leaving the scope reverts the value the subscriber last saw
+        assert notifications[-1] == {simple_graph.c: 23}
+        assert simple_graph.c() == 23
+
+        # The value notified inside the scope does not hide the same value written to the root state
+        simple_graph.a.set_value(1)
+        assert notifications[-1] == {simple_graph.c: 5}
+        assert len(notifications) == 4
+    finally:
+        simple_graph.c.unsubscribe(notifications.append)
+        simple_graph.a.clear_value()
+
+def test_subscribe_batches_writes(simple_graph, dependent_graph):
+    notifications = []
+    callback = notifications.append
+    _graph.subscribe(simple_graph.c, callback)
+    _graph.subscribe(dependent_graph.x, callback)
+    try:
+        with _graph.batch():
+            simple_graph.a.set_value(1)
+            simple_graph.a.set_value(2)
+            assert notifications == []
+        assert notifications == [{simple_graph.c: 7, dependent_graph.x: 6}]
+    finally:
+        _graph.unsubscribe(simple_graph.c, callback)
+        _graph.unsubscribe(dependent_graph.x, callback)
+
+def test_subscribe_skips_unaffected_vertices():
+    class Counted(GraphObject):
+        def __init__(self):
+            self.evaluations = 0
+
+        @Vertex
+        def a(self):
+            return 1
+
+        @Vertex
+        def b(self):
+            return 2
+
+        @Vertex
+        def from_b(self):
+            self.evaluations += 1
+            return self.b() + 1
+
+    counted = Counted()
+    notifications = []
+    counted.from_b.subscribe(notifications.append)
+    try:
+        counted.a.set_value(5)
+        assert notifications == []
+        assert counted.evaluations == 1
+    finally:
+        counted.from_b.unsubscribe(notifications.append)
+
+# Test invalidation through the cached downstream closure
+def test_invalidation_stops_at_fixed_vertices():
+    class Chain(GraphObject):
+        def __init__(self):
+            self.evaluations = 0
+
+        @Vertex
+        def a(self):
+            return 1
+
+        @Vertex
+        def b(self):
+            return self.a() + 1
+
+        @Vertex
+        def c(self):
+            self.evaluations += 1
+            return self.b() + 1
+
+        @Vertex
+        def d(self):
+            return self.a() + self.c()
+
+    chain = Chain()
+    assert chain.d() == 4
+    chain.b.set_value(10)
+    assert chain.d() == 12
+    assert chain.evaluations == 2
+
+    # c only depends on a through the fixed b, so only d is recomputed
+    chain.a.set_value(5)
+    assert chain.d() == 16
+    assert chain.evaluations == 2
+
+def test_downstream_closure_cache(simple_graph, dependent_graph):
+    simple_graph.c()
+    closure = _graph._downstream(simple_graph.a)
+    assert closure == (simple_graph.b, simple_graph.c)
+    assert _graph._downstream(simple_graph.a) is closure
+
+    # A new edge drops the cached closures
+    dependent_graph.x()
+    closure = _graph._downstream(simple_graph.a)
+    assert set(closure) == {simple_graph.b, simple_graph.c, dependent_graph.x}
+    assert closure.index(simple_graph.b) < closure.index(simple_graph.c)
+
+# Test reachability queries
+class Diamond(GraphObject):
+    @Vertex
+    def top(self):
+        return 1
+
+    @Vertex
+    def left(self):
+        return self.top() + 1
+
+    @Vertex
+    def right(self):
+        return self.top() + 2
+
+    @Vertex
+    def bottom(self):
+        return self.left() + self.right() + self.top()
+
+def test_ancestors_and_descendants():
+    diamond = Diamond()
+    diamond.bottom()
+
+    ancestors = _graph.ancestors(diamond.bottom)
+    assert set(ancestors) == {diamond.top, diamond.left, diamond.right}
+    assert ancestors[0] is diamond.top
+    assert _graph.ancestors(diamond.bottom, inputs_only=True) == (diamond.top,)
+
+    descendants = _graph.descendants(diamond.top)
+    assert set(descendants) == {diamond.left, diamond.right, diamond.bottom}
+    assert descendants[-1] is diamond.bottom
+    assert _graph.descendants(diamond.top, outputs_only=True) == (diamond.bottom,)
+
+def test_depends_on_and_affects():
+    diamond = Diamond()
+    other = Diamond()
+    diamond.bottom()
+    other.bottom()
+
+    assert _graph.depends_on(diamond.bottom, diamond.top)
+    assert _graph.depends_on(diamond.left, diamond.top)
+    assert not _graph.depends_on(diamond.top, diamond.bottom)
+    assert not _graph.depends_on(diamond.left, diamond.right)
+    assert not _graph.depends_on(diamond.bottom, other.top)
+    assert _graph.affects(diamond.top, diamond.bottom)
+    assert not _graph.affects(diamond.bottom, diamond.top)
+
+def test_count_paths():
+    diamond = Diamond()
+    diamond.bottom()
+
+    assert _graph.count_paths(diamond.top, diamond.bottom) == 3
+    assert _graph.count_paths(diamond.left, diamond.bottom) == 1
+    assert _graph.count_paths(diamond.bottom, diamond.top) == 0
+
+# Test warming the graph
+class FanOut(GraphObject):
+    def __init__(self, source, factor):
+        self.source = source
+        self.factor = factor
+        self.evaluations = 0
+
+    @Vertex
+    def value(self):
+        self.evaluations += 1
+        return self.source.a() * self.factor
+
+class FanIn(GraphObject):
+    def __init__(self, branches):
+        self.branches = branches
+
+    @Vertex
+    def total(self):
+        return sum(branch.value() for branch in self.branches)
+
+def test_warm_in_waves(simple_graph):
+    branches = [FanOut(simple_graph, factor) for factor in range(20)]
+    fan_in = FanIn(branches)
+    assert fan_in.total() == 5 * 190
+    assert simple_graph.c() == 13
+
+    simple_graph.a.set_value(1)
+    waves = []
+    timings = _graph.warm([simple_graph.a], parallel=4, progress=lambda *wave: waves.append(wave))
+
+    assert [size for _, size, _ in waves] == [1, 21, 2]
+    assert len(timings) == 3
+    assert all(branch.evaluations == 2 for branch in branches)
+    assert fan_in.total() == 190
+    assert simple_graph.c() == 5
+
+class Quote(GraphObject):
+    evaluations = 0
+
+    @Vertex
+    def mid(self):
+        Quote.evaluations += 1
+        time.sleep(0.02)
+        return 100
+
+class Hedge(GraphObject):
+    def __init__(self, quote, ratio):
+        self.quote = quote
+        self.ratio = ratio
+
+    @Vertex
+    def notional(self):
+        return self.quote.mid() * self.ratio
+
+def test_warm_evaluates_new_shared_parents_once():
+    quote = Quote()
+    hedges = [Hedge(quote, ratio) for ratio in range(8)]
+    Quote.evaluations = 0
+    # No edge to the quote is known yet, so every hedge lands in the same wave
+    _graph.warm([hedge.notional for hedge in hedges], parallel=8)
+    assert Quote.evaluations == 1
+    assert not _graph.is_concurrent
+    assert [hedge.notional() for hedge in hedges] == [100 * ratio for ratio in range(8)]
+
+def test_ensure_vertex_evaluated(simple_graph):
+    simple_graph.c()
+    simple_graph.a.set_value(2)
+    _graph.ensure_vertex_evaluated(simple_graph.a)
+    assert _graph.active_state[simple_graph.c].is_valid()
+    assert simple_graph.c() == 7
+
+# Test structural sharing of pure vertices
+class Underlying(GraphObject):
+    @Vertex
+    def spot(self):
+        return 100
+
+class Position(GraphObject):
+    evaluations = 0
+
+    def __init__(self, underlying, quantity):
+        self.underlying = underlying
+        self._quantity = quantity
+
+    @Vertex
+    def quantity(self):
+        return self._quantity
+
+    @Vertex(pure=True)
+    def value(self):
+        Position.evaluations += 1
+        return self.underlying.spot() * self.quantity()
+
+def test_structural_sharing():
+    underlying = Underlying()
+    positions = [Position(underlying, 10) for _ in range(5)] + [Position(underlying, 20)]
+    _graph.enable_sharing()
+    try:
+        Position.evaluations = 0
+        _graph.reset_timings()
+        assert [position.value() for position in positions] == [1000] * 5 + [2000]
+
+        underlying.spot.set_value(50)
+        assert [position.value() for position in positions] == [500] * 5 + [1000]
+        # Fresh positions predict their parents from the first one, so each distinct quantity is evaluated once per spot
+        assert Position.evaluations == 4
+        assert _graph.shared_hits['Position.value'] == 8
+    finally:
+        _graph.disable_sharing()
+        _graph.reset_timings()
+
+    underlying.spot.set_value(60)
+    assert positions[0].value() == 600
+    assert positions[1].value() == 600
+    assert Position.evaluations == 6
+
+# Test the SetScope journal
+def test_set_scope_does_not_evaluate():
+    class Lazy(GraphObject):
+        evaluations = 0
+
+        @Vertex
+        def base(self):
+            Lazy.evaluations += 1
+            return 1
+
+        @Vertex
+        def derived(self):
+            Lazy.evaluations += 1
+            return self.base() + 1
+
+        @Vertex
+        def total(self):
+            return self.derived() * 10
+
+    lazy = Lazy()
+    lazy.base.set_value(5)
+    with SetScope({lazy.base: 7, lazy.derived: 100}):
+        assert Lazy.evaluations == 0
+        assert lazy.total() == 1000
+    assert lazy.base.is_fixed()
+    assert not lazy.derived.is_fixed()
+    assert lazy.total() == 60
+    assert Lazy.evaluations == 1
+
+def test_set_scope_notifies_once(simple_graph):
+    notifications = []
+    simple_graph.c.subscribe(notifications.append)
+    try:
+        with SetScope({simple_graph.a: 1, simple_graph.b: 4}):
+            assert notifications == [{simple_graph.c: 7}]
+        assert notifications == [{simple_graph.c: 7}, {simple_graph.c: 13}]
+    finally:
+        simple_graph.c.unsubscribe(notifications.append)
+
+# Test the metrics counters
+def test_metrics(simple_graph):
+    _graph.reset_metrics()
+    assert simple_graph.c() == 13
+    assert simple_graph.c() == 13
+    simple_graph.a.set_value(1)
+    with DiddleScope():
+        pass
+
+    metrics = _graph.metrics()
+    assert metrics['evaluations'] == 3
+    assert metrics['cache_hits'] == 1
+    assert metrics['invalidations'] == 2
+    assert metrics['set_value_calls'] == 1
+    assert metrics['diddle_enters'] == 1
+    assert metrics['payload_copies'] == len(_graph.active_state)
+    assert metrics['payloads'][threading.current_thread().name] == [len(_graph.active_state)]
+
+# Test exporting the graph
+def test_export_formats(tmp_path):
+    import json
+    import xml.etree.ElementTree as ElementTree
+
+    diamond = Diamond()
+    diamond.bottom()
+
+    _graph.export(tmp_path / 'graph.json', around=diamond.bottom)
+    exported = json.loads((tmp_path / 'graph.json').read_text())
+    layers = {node['label']: node['layer'] for node in exported['nodes']}
+    assert layers == {'Diamond.top': 0, 'Diamond.left': 1, 'Diamond.right': 1, 'Diamond.bottom': 2}
+    assert len(exported['edges']) == 5
+
+    _graph.export(tmp_path / 'graph.dot', around=diamond.left, depth=1)
+    dot = (tmp_path / 'graph.dot').read_text()
+    assert dot.startswith('digraph {')
+    assert dot.count('->') == 3
+    assert '"Diamond.right"' not in dot
+
+    _graph.export(tmp_path / 'graph.xml', format='graphml', around=diamond.top)
+    root = ElementTree.parse(tmp_path / 'graph.xml').getroot()
+    namespace = '{http://graphml.graphdrawing.org/xmlns}'
+    assert len(root.findall('.//{}node'.format(namespace))) == 4
+    assert len(root.findall('.//{}edge'.format(namespace))) == 5
+
+    with pytest.raises(ValueError):
+        _graph.export(tmp_path / 'graph.txt')
+
+def test_render(tmp_path):
+    diamond = Diamond()
+    diamond.bottom()
+    _graph.render(tmp_path / 'graph.svg', around=diamond.bottom)
+    assert (tmp_path / 'graph.svg').read_text().lstrip().startswith('<?xml')
+
+class SlowLegs(GraphObject):
+    @Vertex
+    def left(self):
+        time.sleep(0.02)
+        return 1
+
+    @Vertex
+    def right(self):
+        time.sleep(0.02)
+        return 2
+
+    @Vertex
+    def total(self):
+        return self.left() + self.right()
+
+def test_deadline_aborts_and_resumes():
+    legs = SlowLegs()
+    with pytest.raises(EvaluationAborted) as aborted:
+        legs.total(deadline=time.monotonic() + 0.01)
+    stats = aborted.value.stats
+    assert stats['reason'] == 'deadline'
+    assert stats['evaluated'] == 1
+    assert stats['vertex'] is legs.right
+    assert stats['elapsed'] >= 0.01
+
+    # The vertices evaluated before the abort stay valid, so resuming only evaluates the rest
+    evaluations = _graph.metrics()['evaluations']
+    assert legs.total() == 3
+    assert _graph.metrics()['evaluations'] - evaluations == 2
+
+def test_cancellation_token():
+    legs = SlowLegs()
+    token = CancellationToken()
+    assert legs.total(token=token) == 3
+
+    _graph.set_value(legs.left, 10)
+    token.cancel()
+    with pytest.raises(EvaluationAborted) as aborted:
+        legs.total(token=token)
+    assert aborted.value.stats['reason'] == 'cancelled'
+    assert aborted.value.stats['evaluated'] == 0
+    assert legs.total() == 12
+
+class Shared(GraphObject):
+    def __init__(self):
+        super(Shared, self).__init__()
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    @Vertex
+    def spot(self):
+        return 100
+
+    @Vertex
+    def price(self):
+        spot = self.spot()
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if spot < 0:
+            raise ValueError('negative spot')
+        return spot * 2
+
+def _call_in_threads(vertex, count):
+    results = [None] * count
+    def run(index):
+        try:
+            results[index] = vertex()
+        except Exception as ex:
+            results[index] = ex
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def test_concurrency_single_flight():
+    shared = Shared()
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 8)
+        shared.started.wait(5)
+        shared.release.set()
+        for thread in threads:
+            thread.join()
+        assert results == [200] * 8
+        assert shared.calls == 1
+        assert shared.price() == 200
+        assert shared.calls == 1
+    finally:
+        _graph.disable_concurrency()
+
+def test_concurrency_errors_are_shared_not_cached():
+    shared = Shared()
+    _graph.set_value(shared.spot, -1)
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 4)
+        shared.started.wait(5)
+        shared.release.set()
+        for thread in threads:
+            thread.join()
+        assert all(isinstance(result, ValueError) for result in results)
+        assert shared.calls == 1
+        with pytest.raises(ValueError):
+            shared.price()
+        assert shared.calls == 2
+    finally:
+        _graph.disable_concurrency()
+
+def test_concurrency_drops_stale_results():
+    shared = Shared()
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 1)
+        shared.started.wait(5)
+        # The write lands while the other thread evaluates price from the previous spot
+        _graph.set_value(shared.spot, 150)
+        shared.release.set()
+        threads[0].join()
+        assert results == [200]
+        assert shared.price() == 300
+        assert shared.calls == 2
+    finally:
+        _graph.disable_concurrency()
+
+def test_concurrency_keeps_results_of_unrelated_writes():
+    shared, other = Shared(), Shared()
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 1)
+        shared.started.wait(5)
+        # The write does not reach price, which is still cached once evaluated
+        _graph.set_value(other.spot, 150)
+        shared.release.set()
+        threads[0].join()
+        assert results == [200]
+        assert shared.price() == 200
+        assert shared.calls == 1
+    finally:
+        _graph.disable_concurrency()
+
+def test_concurrency_keeps_values_set_during_evaluation():
+    shared = Shared()
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 1)
+        shared.started.wait(5)
+        # The value set on price itself is not overwritten by the evaluation landing after it
+        _graph.set_value(shared.price, 5)
+        shared.release.set()
+        threads[0].join()
+        assert results == [200]
+        assert shared.price() == 5
+    finally:
+        _graph.disable_concurrency()
+
+def test_concurrency_set_scope_drops_stale_results():
+    shared = Shared()
+    _graph.enable_concurrency()
+    try:
+        threads, results = _call_in_threads(shared.price, 1)
+        shared.started.wait(5)
+        with SetScope({shared.spot: 150}):
+            shared.release.set()
+            threads[0].join()
+            assert results == [200]
+            assert shared.price() == 300
+        assert shared.price() == 200
+    finally:
+        _graph.disable_concurrency()
+
+class Block(GraphObject):
+    def __init__(self, index):
+        super(Block, self).__init__()
+        self.index = index
+
+    @Vertex
+    def data(self):
+        return bytes([self.index]) * 1000
+
+    @Vertex
+    def checksum(self):
+        return sum(self.data())
+
+def test_concurrency_with_spill(tmp_path):
+    blocks = [Block(index) for index in range(40)]
+    _graph.enable_concurrency()
+    _graph.enable_spill(threshold=1000, budget=20000, directory=tmp_path)
+    try:
+        errors = []
+        def run(offset):
+            try:
+                for round in range(5):
+                    for block in blocks[offset:] + blocks[:offset]:
+                        assert block.data() == bytes([block.index]) * 1000
+                        assert block.checksum() == block.index * 1000
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=run, args=(offset * 10,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        stats = _graph.spill_stats
+        assert stats['spilled'] > 0 and stats['loaded'] > 0
+        assert stats['resident_bytes'] <= 20000
+    finally:
+        _graph.disable_spill()
+        _graph.disable_concurrency()
+
+class Hedged(Shared):
+    @Vertex
+    def hedge(self):
+        return -10
+
+    @Vertex
+    def price(self):
+        spot = self.spot()
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        # The deadline of the evaluating thread has passed by the time it gets here
+        return spot * 2 + self.hedge()
+
+def test_concurrency_aborts_are_not_shared():
+    hedged = Hedged()
+    _graph.enable_concurrency()
+    try:
+        aborted = []
+        def run():
+            try:
+                hedged.price(deadline=time.monotonic() + 0.01)
+            except EvaluationAborted as ex:
+                aborted.append(ex)
+        owner = threading.Thread(target=run)
+        owner.start()
+        hedged.started.wait(5)
+        # A thread without a deadline waits on the evaluation of the owner, then evaluates price itself once it aborts
+        threads, results = _call_in_threads(hedged.price, 1)
+        time.sleep(0.05)
+        hedged.release.set()
+        owner.join()
+        threads[0].join()
+        assert len(aborted) == 1
+        assert results == [190]
+        assert hedged.calls == 2
+    finally:
+        _graph.disable_concurrency()
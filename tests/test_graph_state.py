@@ -136,4 +136,179 @@ def test_graph_calculation_state():
     
     # During calculation
     result = obj.dependent()  # This will trigger calculation
-    assert result == 84  # Verify result 
\ No newline at end of file
+    assert result == 84  # Verify result
+
+class Curve(GraphObject):
+    def __init__(self, name):
+        self.graph_key = name
+        self.evaluations = 0
+
+    @Vertex
+    def rate(self):
+        return 0.01
+
+    @Vertex
+    def discount(self):
+        self.evaluations += 1
+        return 1 / (1 + self.rate())
+
+def test_snapshot_restore(tmp_path):
+    """Test restoring a snapshot into objects that never evaluated anything"""
+    from src.enhancement.graph import GraphState, _graph
+
+    path = tmp_path / 'state.snapshot'
+    curve = Curve('usd')
+    curve.rate.set_value(0.25)
+    assert curve.discount() == 0.8
+    _graph.active_state.snapshot(path)
+
+    restarted = Curve('usd')
+    state = GraphState(_graph)
+    assert state.restore(path, objects=[restarted]) == 2
+    _graph.push_state(state)
+    try:
+        assert restarted.rate.is_fixed()
+        assert restarted.discount() == 0.8
+        assert restarted.evaluations == 0
+
+        # The restored edges still propagate writes
+        restarted.rate.set_value(1)
+        assert restarted.discount() == 0.5
+        assert restarted.evaluations == 1
+    finally:
+        _graph.pop_state()
+
+def test_restore_invalidates_derived_values(tmp_path):
+    """Test that restoring over a payload invalidates the values derived from it in the state"""
+    from src.enhancement.graph import GraphState, _graph
+
+    path = tmp_path / 'state.snapshot'
+    curve = Curve('eur')
+    state = GraphState(_graph)
+    _graph.push_state(state)
+    try:
+        curve.rate.set_value(0.25)
+        state.snapshot(path)
+    finally:
+        _graph.pop_state()
+
+    fresh = GraphState(_graph)
+    _graph.push_state(fresh)
+    try:
+        assert curve.discount() == 1 / 1.01
+        fresh.restore(path, objects=[curve])
+        assert curve.rate() == 0.25
+        assert curve.discount() == 0.8
+    finally:
+        _graph.pop_state()
+
+def test_snapshot_skips_unpicklable_values(tmp_path):
+    """Test that unpicklable derived values and their descendants are recomputed after a restore"""
+    import threading
+    from src.enhancement.graph import GraphState, _graph
+
+    class Locked(GraphObject):
+        graph_key = 'locked'
+
+        @Vertex
+        def lock(self):
+            return threading.Lock()
+
+        @Vertex
+        def locked(self):
+            return self.lock().locked()
+
+        @Vertex
+        def name(self):
+            return 'locked'
+
+    path = tmp_path / 'state.snapshot'
+    obj = Locked()
+    assert obj.locked() is False
+    assert obj.name() == 'locked'
+    state = GraphState(_graph)
+    _graph.active_state.copy(state)
+    state.snapshot(path)
+
+    restored = GraphState(_graph)
+    restored.restore(path)
+    assert restored[obj.name].value == 'locked'
+    assert obj.lock not in restored
+    assert obj.locked not in restored
+
+def test_snapshot_skips_ambiguous_vertices(tmp_path):
+    """Test that the descendants of every vertex with an ambiguous stable_id are recomputed after a restore"""
+    from src.enhancement.graph import GraphState, _graph
+
+    class Position(GraphObject):
+        graph_key = 'position'
+
+        def __init__(self, quantity):
+            self.quantity = quantity
+
+        @Vertex
+        def value(self):
+            return self.quantity
+
+    class Book(GraphObject):
+        def __init__(self, name, position):
+            self.graph_key = name
+            self.position = position
+
+        @Vertex
+        def total(self):
+            return self.position.value() * 10
+
+    path = tmp_path / 'state.snapshot'
+    books = [Book('first', Position(1)), Book('second', Position(2))]
+    assert [book.total() for book in books] == [10, 20]
+    state = GraphState(_graph)
+    _graph.active_state.copy(state)
+    state.snapshot(path)
+
+    restored = GraphState(_graph)
+    restored.restore(path, objects=books)
+    for book in books:
+        assert book.total not in restored
+
+def test_spill_large_values(tmp_path):
+    """Test that large values over the resident budget are spilled to disk and read back"""
+    from src.enhancement.graph import VertexPayload, _graph
+
+    class Blobs(GraphObject):
+        @Vertex
+        def small(self):
+            return 1
+
+        @Vertex
+        def first(self):
+            return b'1' * 1000
+
+        @Vertex
+        def second(self):
+            return b'2' * 1000
+
+        @Vertex
+        def third(self):
+            return [b'3' * 500, b'3' * 500]
+
+    blobs = Blobs()
+    _graph.enable_spill(threshold=500, budget=2500, directory=tmp_path)
+    try:
+        assert blobs.small() == 1
+        assert blobs.first() == b'1' * 1000
+        assert blobs.second() == b'2' * 1000
+        assert blobs.third() == [b'3' * 500, b'3' * 500]
+
+        state = _graph.active_state
+        assert state[blobs.first].flags & VertexPayload.DEFERRED
+        assert not state[blobs.third].flags & VertexPayload.DEFERRED
+        assert _graph.spill_stats['spilled'] == 1
+
+        # Reading the spilled value back spills the least recently used one instead
+        assert blobs.first() == b'1' * 1000
+        assert not state[blobs.first].flags & VertexPayload.DEFERRED
+        assert state[blobs.second].flags & VertexPayload.DEFERRED
+        assert _graph.spill_stats['loaded'] == 1
+    finally:
+        _graph.disable_spill()
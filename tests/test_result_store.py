@@ -0,0 +1,144 @@
+import os
+import subprocess
+import sys
+import pytest
+from enhancement.graph import GraphObject, Vertex, GraphState, _graph
+from enhancement.result_store import ResultStore, stable_hash
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultStore(tmp_path / 'results.sqlite')
+    yield store
+    store.close()
+
+def test_put_get(store):
+    """Test storing and retrieving results"""
+    key = stable_hash(('calibrate', 'usd'))
+    assert store.get(key) is None
+    store.put(key, {'rate': 0.05})
+    assert key in store
+    assert store.get(key) == {'rate': 0.05}
+    assert store.stats == {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': store.stats['bytes']}
+
+def test_peek_does_not_count(store):
+    """Test that peek leaves the stats untouched"""
+    store.put('key', 1)
+    assert store.peek('key') == 1
+    assert store.peek('other', 2) == 2
+    assert store.stats['hits'] == 0
+    assert store.stats['misses'] == 0
+
+def test_eviction(tmp_path):
+    """Test that the least recently used entries are evicted over max_bytes"""
+    store = ResultStore(tmp_path / 'results.sqlite', max_bytes=2500)
+    store.put('a', b'a' * 1000)
+    store.put('b', b'b' * 1000)
+    store.get('a')
+    store.put('c', b'c' * 1000)
+    assert 'a' in store
+    assert 'b' not in store
+    assert 'c' in store
+    assert store.stats['evictions'] == 1
+    store.close()
+
+def test_size_total(tmp_path):
+    """Test that the stored size follows replaced and cleared entries"""
+    store = ResultStore(tmp_path / 'results.sqlite')
+    store.put('a', b'a' * 1000)
+    size = store.stats['bytes']
+    store.put('a', b'a' * 2000)
+    store.put('b', b'b' * 1000)
+    assert store.stats['bytes'] == 2 * size + 1000
+    store.clear()
+    assert store.stats['bytes'] == 0
+    store.close()
+
+def _put_in_child(store):
+    store.put('child', store.get('parent') + 1)
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_worker(tmp_path):
+    """Test that a forked worker opens its own connection"""
+    import multiprocessing
+    store = ResultStore(tmp_path / 'results.sqlite')
+    store.put('parent', 1)
+    worker = multiprocessing.get_context('fork').Process(target=_put_in_child, args=(store,))
+    worker.start()
+    worker.join(30)
+    assert worker.exitcode == 0
+    assert store.get('child') == 2
+    store.close()
+
+def test_shared_between_instances(tmp_path):
+    """Test that results are visible to another store on the same file"""
+    first = ResultStore(tmp_path / 'results.sqlite')
+    second = ResultStore(tmp_path / 'results.sqlite')
+    first.put('key', [1, 2, 3])
+    assert second.get('key') == [1, 2, 3]
+    first.close()
+    second.close()
+
+def test_stable_hash():
+    """Test that equal values hash the same"""
+    assert stable_hash((1, 'a', [2.5])) == stable_hash((1, 'a', [2.5]))
+    assert stable_hash((1, 'a')) != stable_hash((1, 'b'))
+    assert stable_hash({'a': 1, 'b': 2}) == stable_hash({'b': 2, 'a': 1})
+    assert stable_hash((1, 2)) != stable_hash([1, 2])
+    assert stable_hash(1) != stable_hash(True)
+
+def test_stable_hash_ignores_identity():
+    """Test that equal strings hash the same whether or not they are the same object"""
+    a, b = 'curve' * 10, ''.join(['curve'] * 10)
+    assert a == b and a is not b
+    assert stable_hash((a, a)) == stable_hash((a, b))
+
+def test_stable_hash_across_processes():
+    """Test that sets and dicts hash the same under different hash seeds"""
+    code = (
+        'from enhancement.result_store import stable_hash\n'
+        "print(stable_hash(({'usd', 'eur', 'gbp', 'jpy'}, {'a': frozenset('xyz'), 'b': 2.5})))"
+    )
+    digests = set()
+    for seed in ('1', '2', '3', '4'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        digests.add(subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout)
+    assert len(digests) == 1
+
+def test_stored_vertex(store):
+    """Test that a stored vertex is reused by a fresh object and recomputed when its parents change"""
+    calls = []
+
+    class Calibration(GraphObject):
+        def __init__(self, name):
+            self.graph_key = name
+
+        @Vertex
+        def quote(self):
+            return 1.5
+
+        @Vertex(store=store)
+        def curve(self):
+            calls.append(self.graph_key)
+            return self.quote() * 2
+
+    assert Calibration('eur').curve() == 3.0
+    assert calls == ['eur']
+
+    # A fresh object in a fresh state finds the stored result through the recorded parents
+    state = GraphState(_graph)
+    _graph.push_state(state)
+    try:
+        restarted = Calibration('gbp')
+        restarted.graph_key = 'eur'
+        assert restarted.curve() == 3.0
+        assert calls == ['eur']
+        assert restarted.quote in restarted.curve.parents
+
+        restarted.quote.set_value(2)
+        assert restarted.curve() == 4.0
+        assert calls == ['eur', 'eur']
+    finally:
+        _graph.pop_state()
+
+    assert store.stats['hits'] == 1
+    assert store.stats['misses'] == 2